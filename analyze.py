@@ -1,6 +1,10 @@
 import os
-from openai import OpenAI
-from PIL import Image
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import openai_client
+from PIL import Image, ImageOps
 import base64
 from io import BytesIO
 from loguru import logger
@@ -8,36 +12,62 @@ from loguru import logger
 
 img_path = "./20130215_358292.jpg"
 
-def encode_image_to_base64(img_path):
+# 送信前に長辺をこのピクセル数まで縮小する
+MAX_EDGE = int(os.environ.get("HOMECARE_IMAGE_MAX_EDGE", "1024"))
+JPEG_QUALITY = int(os.environ.get("HOMECARE_IMAGE_JPEG_QUALITY", "85"))
+IMAGE_CONCURRENCY = int(os.environ.get("HOMECARE_IMAGE_CONCURRENCY", "4"))
+# 変換せずにそのまま送れる形式
+PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+IMAGE_MODEL = "gpt-4o"
+SYSTEM_PROMPT = "あなたは経験豊富な専門医です。医療の専門家として、画像を詳しく分析し、医学的な見地から説明してください。"
+USER_PROMPT = "この画像について医学的な観点から鑑別を上げて下さい。"
+# プロンプトや縮小サイズを変えたらキャッシュ済みの解析結果を使わないようにする
+IMAGE_PROMPT_VERSION = hashlib.sha256(f"{SYSTEM_PROMPT}\n{USER_PROMPT}\n{MAX_EDGE}".encode("utf-8")).hexdigest()[:12]
+
+def prepare_image(img_path, max_edge: int = MAX_EDGE):
+    """送信用の画像バイト列とMIMEタイプを返す。JPEG/WebPで縮小不要ならファイルをそのまま使う"""
     with Image.open(img_path) as image:
+        # EXIFの回転情報があると元ファイルのままでは向きが変わるため変換する
+        rotated = image.getexif().get(0x0112, 1) != 1
+        if image.format in PASSTHROUGH_FORMATS and max(image.size) <= max_edge and not rotated:
+            with open(img_path, "rb") as f:
+                return f.read(), PASSTHROUGH_FORMATS[image.format]
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge))
         buffered = BytesIO()
-        image.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
+        image.convert("RGB").save(buffered, format="JPEG", quality=JPEG_QUALITY)
+        return buffered.getvalue(), "image/jpeg"
 
-def analyze_image(img_path):
-    client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+def analyze_image_detail(img_path, max_edge: int = MAX_EDGE) -> dict:
+    """解析結果に送信バイト数とレイテンシを添えて返す"""
+    client = openai_client.get_client()
     
-    # 画像をbase64エンコード
-    base64_image = encode_image_to_base64(img_path)
+    # 画像を縮小・base64エンコード
+    image_bytes, mime = prepare_image(img_path, max_edge)
+    base64_image = base64.b64encode(image_bytes).decode('utf-8')
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
+    start = time.perf_counter()
+    response = openai_client.call(
+        "analyze_image",
+        client.chat.completions.create,
+        model=IMAGE_MODEL,
         messages=[
             {
                 "role": "system",
-                "content": "あなたは経験豊富な専門医です。医療の専門家として、画像を詳しく分析し、医学的な見地から説明してください。"
+                "content": SYSTEM_PROMPT
             },
             {
                 "role": "user",
                 "content": [
                     {
                         "type": "text", 
-                        "text": "この画像について医学的な観点から鑑別を上げて下さい。"
+                        "text": USER_PROMPT
                     },
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/png;base64,{base64_image}"
+                            "url": f"data:{mime};base64,{base64_image}"
                         }
                     }
                 ]
@@ -46,16 +76,49 @@ def analyze_image(img_path):
         max_tokens=300
     )
     
-    return response.choices[0].message.content
+    return {
+        "img_path": img_path,
+        "result": response.choices[0].message.content,
+        "original_bytes": os.path.getsize(img_path),
+        # 縮小後の画像のバイト数（original_bytesと同じ単位）と、実際に送るbase64の文字数
+        "bytes_sent": len(image_bytes),
+        "base64_bytes": len(base64_image),
+        "latency_sec": round(time.perf_counter() - start, 3),
+    }
+
+def analyze_image(img_path):
+    return analyze_image_detail(img_path)["result"]
+
+def analyze_images(img_paths, out_path: str = "analysis.jsonl", concurrency: int = IMAGE_CONCURRENCY,
+                   max_edge: int = MAX_EDGE) -> list:
+    """複数の画像を並列に解析し、終わったものから1行ずつJSONLに書き出す"""
+    results = []
+    with open(out_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(analyze_image_detail, path, max_edge): path for path in img_paths}
+        for future in as_completed(futures):
+            try:
+                row = future.result()
+            except Exception as e:
+                row = {"img_path": futures[future], "error": str(e)}
+                logger.error(f"画像解析エラー: {futures[future]}: {str(e)}")
+            else:
+                logger.info(
+                    f"{row['img_path']}: {row['original_bytes']} -> {row['bytes_sent']} bytes, {row['latency_sec']:.2f}秒"
+                )
+            # as_completedで結果を受け取るこのスレッドだけが書き込む
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            out.flush()
+            results.append(row)
+    return results
 
 if __name__ == "__main__":
     import glob
-    import os
 
     data_dir = "./data"
-    img_paths = glob.glob(os.path.join(data_dir, "*.jpg"))
-    result = 
-    for img_path in img_paths:
-        logger.info(f"img_path: {img_path}")
-        result = analyze_image(img_path=img_path)
-        logger.info(f"result: {result}")
+    img_paths = sorted(glob.glob(os.path.join(data_dir, "*.jpg")) + glob.glob(os.path.join(data_dir, "*.png")))
+    start = time.perf_counter()
+    results = analyze_images(img_paths)
+    for result in results:
+        logger.info(f"img_path: {result['img_path']}")
+        logger.info(f"result: {result.get('result', result.get('error'))}")
+    logger.success(f"{len(results)}枚の解析完了: {time.perf_counter() - start:.2f}秒")
@@ -1,96 +1,246 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
 from flask_cors import CORS
 import os
-from werkzeug.utils import secure_filename
-from make_report import make_report
-from make_text import transcribe_audio
+import sys
+import json
+import time
 from loguru import logger
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from jobs import JobManager, QueueFullError, stage_timer
+from uploads import save_upload, file_sha256, UploadError
+from result_cache import ResultCache, transcript_key, report_key
+from soap import split_soap_sections
+from record_store import RecordStore, VisitRecord
+from compaction import COMPACT_TRANSCRIPT, compact_transcript
+from backends import configured_routers
+from telemetry import span, trace, in_context, log_payload, payload_bytes, stage_seconds, render_metrics
+
+# HOMECARE_FAKE=1 でAPIを呼ばないダミー処理に切り替え（ローカル動作確認用）
+FAKE = os.environ.get("HOMECARE_FAKE") == "1"
+if FAKE:
+    from jobs import fake_analyze_image_detail as analyze_image_detail
+    IMAGE_MODEL = IMAGE_PROMPT_VERSION = "fake"
+    IMAGE_CONCURRENCY = 4
+else:
+    from analyze import analyze_image_detail, IMAGE_MODEL, IMAGE_PROMPT_VERSION, IMAGE_CONCURRENCY
+
+# 文字起こし・レポート生成のバックエンド（HOMECARE_TRANSCRIBE_BACKEND / HOMECARE_REPORT_BACKEND = api / local）。
+# localのモデルはロード時に読み込むので、API専用の構成は起動が速い
+transcribe_router, report_router = configured_routers(fake=FAKE)
+
+# HOMECARE_PIPELINE=1 で長い録音は文字起こしと並行してSOAPの下書きを進め、最後は残りを反映するだけにする（API構成のみ）
+PIPELINE = (os.environ.get("HOMECARE_PIPELINE") == "1" and not FAKE
+            and transcribe_router.primary.name == "api" and report_router.primary.name == "api")
+if PIPELINE:
+    from drafting import pipelined_transcribe, finish_report_stream, should_pipeline, cache_identity, PIPELINE_POLISH
 
 app = Flask(__name__)
 CORS(app)
 
+# HOMECARE_LOG_JSON=1 でログをJSONで出力する（スパンのtrace_id・duration_secなどがフィールドになる）
+if os.environ.get("HOMECARE_LOG_JSON") == "1":
+    logger.remove()
+    logger.add(sys.stderr, serialize=True)
+
+# HOMECARE_WARMUP="whisper-turbo,weblab-GENIAC/Tanuki-8B-dpo-v1.0" のように指定すると
+# 起動時にバックグラウンドでローカルモデルをロードしておく
+WARMUP_MODELS = [m.strip() for m in os.environ.get("HOMECARE_WARMUP", "").split(",") if m.strip()]
+if WARMUP_MODELS:
+    import threading
+    import make_text, make_report  # ローダーを登録するためにインポート（モデル本体の読み込みはロード時）
+    from model_registry import registry
+    threading.Thread(target=registry.warmup, args=(WARMUP_MODELS,), daemon=True).start()
+
 # アップロード設定
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'m4a', 'mp3', 'wav', 'mp4'}
+IMAGE_FORMATS = {'jpg', 'png', 'webp'}
+MAX_IMAGES = int(os.environ.get("HOMECARE_MAX_IMAGES", "10"))  # 1リクエストあたりの枚数上限
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# 長時間の録音に対応するため上限を引き上げる（ディスクへ逐次書き込むのでメモリは消費しない）
+MAX_UPLOAD_MB = int(os.environ.get("HOMECARE_MAX_UPLOAD_MB", "200"))
+
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB制限
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# 同じ録音の再アップロードでAPIを呼び直さないよう結果をキャッシュ（HOMECARE_CACHE=0で無効）
+result_cache = ResultCache() if os.environ.get("HOMECARE_CACHE", "1") != "0" else None
+# 利用者IDを付けてアップロードされた訪問の記録を保存する（HOMECARE_RECORD_STORE=0で無効）
+record_store = RecordStore() if os.environ.get("HOMECARE_RECORD_STORE", "1") != "0" else None
 
-def process_audio_file(file_path):
-    """main.pyと同じ処理を実行"""
+def record_cache(job, stage, hit):
+    if job is not None:
+        job.cache[stage] = "hit" if hit else "miss"
+
+def process_audio_file(file_path, job=None):
+    """main.pyと同じ処理を実行（jobを渡すと段階ごとの時間を記録）"""
     try:
         logger.info(f"ファイル処理開始: {file_path}")
         logger.info(f"ファイルサイズ: {os.path.getsize(file_path)} bytes")
         logger.info(f"ファイル拡張子: {os.path.splitext(file_path)[1]}")
         
-        transcript = transcribe_audio(file_path)
-        logger.info(f"transcript: {transcript}")
-        report = make_report(transcript)
-        logger.info(f"report: {report}")
+        # キャッシュは主バックエンドの結果を探し、実際に使ったバックエンドのキーで保存する
+        transcript = None
+        pending_draft = None  # パイプライン処理で作った(下書き, 未反映の文字起こし)
+        if result_cache is not None:
+            sha256 = job.sha256 if job is not None and job.sha256 else file_sha256(file_path)
+            transcript = result_cache.get("transcript", transcript_key(sha256, transcribe_router.primary.model))
+            record_cache(job, "transcribe", transcript is not None)
+        if transcript is None:
+            with stage_timer(job, "transcribe"):
+                if PIPELINE and should_pipeline(file_path):
+                    backend = transcribe_router.primary
+                    transcript, draft, tail = pipelined_transcribe(file_path)
+                    pending_draft = (draft, tail)
+                else:
+                    backend, transcript = transcribe_router.run(file_path)
+            if job is not None:
+                job.backends["transcribe"] = backend.name
+            if result_cache is not None:
+                result_cache.set("transcript", transcript_key(sha256, backend.model), transcript)
+        log_payload("transcript", transcript)
+        if job is not None:
+            job.transcript = transcript
+            job.notify()
+        # レポート生成にはフィラー・繰り返しを除いた文字起こしを渡す（画面・記録には元の文字起こしを使う）
+        report_input = transcript
+        if COMPACT_TRANSCRIPT and pending_draft is None:
+            with stage_timer(job, "compact"):
+                report_input = compact_transcript(transcript)
+        # 利用者IDがあれば、その利用者の直近の記録を経過の参考としてプロンプトに入れる
+        # 同じ録音の再アップロードでは、前回保存したこの録音の記録を含めない（レポートのキャッシュが使えるように）
+        prior = ""
+        if record_store is not None and job is not None and job.patient_id:
+            recording_sha256 = job.sha256 or file_sha256(file_path)
+            prior = record_store.prior_context(job.patient_id, exclude_sha256=recording_sha256)
+        # パイプライン版は下書き用のモデル・プロンプトで作るので、通常のレポートとは別のキーで扱う
+        if pending_draft is not None:
+            report_model, report_version = cache_identity(PIPELINE_POLISH or bool(prior))
+        else:
+            report_model, report_version = report_router.primary.model, report_router.primary.prompt_version
+        report = None
+        if result_cache is not None:
+            report = result_cache.get("report", report_key(report_input, report_model, report_version, prior))
+            record_cache(job, "report", report is not None)
+            if report is not None and job is not None:
+                job.append_report(report)
+        if report is None:
+            with stage_timer(job, "report"):
+                # 差分をjobに流してSSEで途中経過を配信する
+                start = time.perf_counter()
+                report = ""
+                if pending_draft is not None:
+                    stream = finish_report_stream(*pending_draft, prior=prior)
+                else:
+                    stream = report_router.stream(report_input, prior)
+                for delta in stream:
+                    if not report:
+                        first_token = time.perf_counter() - start
+                        stage_seconds.observe(first_token, stage="report_first_token", outcome="ok")
+                        if job is not None:
+                            job.timings["report_first_token"] = round(first_token, 3)
+                    report += delta
+                    if job is not None:
+                        job.append_report(delta)
+            if pending_draft is None:
+                # 代替バックエンドに切り替わった場合はそのモデルのキーで保存する
+                report_model, report_version = stream.backend.model, stream.backend.prompt_version
+            if job is not None:
+                job.backends["report"] = "pipeline" if pending_draft is not None else stream.backend.name
+            if result_cache is not None:
+                result_cache.set("report", report_key(report_input, report_model, report_version, prior), report)
+        log_payload("report", report)
+        if record_store is not None and job is not None and job.patient_id:
+            with stage_timer(job, "save_record"):
+                job.record_id = record_store.add(VisitRecord.from_report(job.patient_id, report, transcript,
+                                                                         sha256=recording_sha256))
         return transcript, report
     except Exception as e:
         logger.error(f"process_audio_file エラー: {str(e)}")
         logger.error(f"エラーの詳細: {traceback.format_exc()}")
         raise
 
+# 文字起こし・レポート生成は上限付きのワーカープールで実行
+job_manager = JobManager(process_audio_file)
+# 画像解析は1訪問分の写真を並列に送る
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_CONCURRENCY, thread_name_prefix="homecare-image")
+
+def analyze_image_file(upload):
+    """キャッシュを確認し、無ければ画像を解析して結果をキャッシュする"""
+    key = f"{upload.sha256}:{IMAGE_MODEL}:{IMAGE_PROMPT_VERSION}"
+    if result_cache is not None:
+        cached = result_cache.get("image", key)
+        if cached is not None:
+            return {**json.loads(cached), 'cached': True}
+    try:
+        with span("image_analyze"):
+            detail = analyze_image_detail(upload.path)
+    except Exception as e:
+        logger.error(f"画像解析エラー: {upload.filename}: {str(e)}")
+        return {'error': str(e), 'cached': False}
+    result = {k: detail[k] for k in ('result', 'bytes_sent', 'latency_sec')}
+    if result_cache is not None:
+        result_cache.set("image", key, json.dumps(result, ensure_ascii=False))
+    return {**result, 'cached': False}
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', max_upload_mb=MAX_UPLOAD_MB)
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
     try:
-        if 'file' not in request.files:
-            logger.error("ファイルがリクエストに含まれていません")
-            return jsonify({'error': 'ファイルが選択されていません'}), 400
+        if request.mimetype == 'application/octet-stream':
+            # 生のリクエストボディをそのまま受け取る（ファイル名はヘッダで指定）
+            filename = request.headers.get('X-Filename', '')
+            patient_id = request.headers.get('X-Patient-Id', '')
+            stream = request.stream
+        else:
+            if 'file' not in request.files:
+                logger.error("ファイルがリクエストに含まれていません")
+                return jsonify({'error': 'ファイルが選択されていません'}), 400
+            file = request.files['file']
+            if file.filename == '':
+                logger.error("ファイル名が空です")
+                return jsonify({'error': 'ファイルが選択されていません'}), 400
+            filename = file.filename
+            patient_id = request.form.get('patient_id', '')
+            stream = file.stream
+            logger.info(f"ファイルのMIMEタイプ: {file.content_type}")
         
-        file = request.files['file']
-        if file.filename == '':
-            logger.error("ファイル名が空です")
-            return jsonify({'error': 'ファイルが選択されていません'}), 400
+        logger.info(f"アップロードされたファイル: {filename}")
         
-        logger.info(f"アップロードされたファイル: {file.filename}")
-        logger.info(f"ファイルのMIMEタイプ: {file.content_type}")
-        logger.info(f"ファイルサイズ: {len(file.read())} bytes")
-        file.seek(0)  # ファイルポインタをリセット
+        # 拡張子ではなく先頭バイトで形式を判定しつつ一意な一時ファイルへ保存
+        try:
+            with span("upload_save"):
+                upload = save_upload(stream, filename, app.config['UPLOAD_FOLDER'],
+                                     ALLOWED_EXTENSIONS, app.config['MAX_CONTENT_LENGTH'])
+            payload_bytes.observe(upload.size, kind="audio")
+        except UploadError as e:
+            logger.error(f"アップロードエラー: {filename}: {str(e)}")
+            return jsonify({'error': str(e)}), e.status_code
         
-        if file and allowed_file(file.filename):
-            # 元のファイル名から拡張子を取得
-            original_ext = os.path.splitext(file.filename)[1].lower()
-            # 安全なファイル名を生成（拡張子を保持）
-            safe_name = secure_filename(file.filename)
-            # 拡張子が失われた場合は追加
-            if not safe_name.endswith(original_ext):
-                safe_name = f"audio{original_ext}"
-            
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], safe_name)
-            file.save(filepath)
-            
-            logger.info(f"ファイル保存完了: {filepath}")
-            
-            # main.pyと同じ処理を実行
-            logger.info(f"音声ファイルを処理中: {safe_name}")
-            transcript, report = process_audio_file(filepath)
-            
-            # 一時ファイルを削除
-            os.remove(filepath)
-            logger.info(f"一時ファイル削除完了: {filepath}")
-            
-            return jsonify({
-                'success': True,
-                'transcript': transcript,
-                'report': report
-            })
-        else:
-            logger.error(f"許可されていないファイル形式: {file.filename}")
-            return jsonify({'error': '許可されていないファイル形式です'}), 400
+        # 処理はワーカーで非同期に実行し、ジョブIDをすぐに返す
+        try:
+            job = job_manager.submit(upload.path, upload.sha256, patient_id.strip() or None)
+        except QueueFullError as e:
+            os.remove(upload.path)
+            logger.error(str(e))
+            return jsonify({'error': '混雑しています。しばらくしてから再度お試しください'}), 503
+        logger.info(f"音声ファイルを処理中: {filename} (job {job.id})")
+        
+        return jsonify({
+            'success': True,
+            'job_id': job.id,
+            'sha256': upload.sha256,
+            'size': upload.size,
+            'status_url': f"/jobs/{job.id}",
+            'result_url': f"/jobs/{job.id}/result"
+        }), 202
             
     except Exception as e:
         error_details = traceback.format_exc()
@@ -101,5 +251,153 @@ def upload_file():
             'details': error_details
         }), 500
 
+@app.route('/analyze-image', methods=['POST'])
+def analyze_image_endpoint():
+    """創傷写真を1枚または複数枚受け取り、並列に解析して結果を返す"""
+    files = [f for f in request.files.getlist('file') + request.files.getlist('files') if f.filename]
+    if not files:
+        return jsonify({'error': 'ファイルが選択されていません'}), 400
+    if len(files) > MAX_IMAGES:
+        return jsonify({'error': f'一度に解析できるのは{MAX_IMAGES}枚までです'}), 400
+
+    start = time.perf_counter()
+    saved = []
+    try:
+        with span("upload_save", images=len(files)):
+            for file in files:
+                saved.append(save_upload(file.stream, file.filename, app.config['UPLOAD_FOLDER'],
+                                         IMAGE_FORMATS, app.config['MAX_CONTENT_LENGTH']))
+                payload_bytes.observe(saved[-1].size, kind="image")
+        # 同じ写真（同一ハッシュ）は1回だけ解析する
+        unique = {}
+        for upload in saved:
+            unique.setdefault(upload.sha256, upload)
+        with trace(), span("analyze_images", images=len(unique)):
+            analyzed = dict(zip(unique.keys(), image_executor.map(in_context(analyze_image_file), unique.values())))
+
+        results = [
+            {'filename': upload.filename, 'sha256': upload.sha256, 'size': upload.size, **analyzed[upload.sha256]}
+            for upload in saved
+        ]
+        elapsed = time.perf_counter() - start
+        logger.info(f"画像解析: {len(saved)}枚（重複除外後{len(unique)}枚）{elapsed:.2f}秒")
+        return jsonify({
+            'success': all('error' not in r for r in results),
+            'results': results,
+            'elapsed_sec': round(elapsed, 3)
+        })
+    except UploadError as e:
+        logger.error(f"アップロードエラー: {str(e)}")
+        return jsonify({'error': str(e)}), e.status_code
+    except Exception as e:
+        error_details = traceback.format_exc()
+        logger.error(f"エラーが発生しました: {str(e)}")
+        logger.error(f"エラーの詳細: {error_details}")
+        return jsonify({
+            'error': f'処理中にエラーが発生しました: {str(e)}',
+            'details': error_details
+        }), 500
+    finally:
+        for upload in saved:
+            if os.path.exists(upload.path):
+                os.remove(upload.path)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    if job.status == 'error':
+        return jsonify({'error': f'処理中にエラーが発生しました: {job.error}', **job.to_dict()}), 500
+    if job.status != 'done':
+        return jsonify({'error': '処理が完了していません', **job.to_dict()}), 409
+    return jsonify({
+        'success': True,
+        'transcript': job.transcript,
+        'report': job.report,
+        'timings': job.timings
+    })
+
+@app.route('/patients/<patient_id>/visits', methods=['GET'])
+def patient_visits(patient_id):
+    """利用者の直近の訪問記録（?n=件数）"""
+    if record_store is None:
+        return jsonify({'error': '記録の保存が無効です'}), 404
+    n = request.args.get('n', 5, type=int)
+    return jsonify({'visits': [v.model_dump() for v in record_store.recent_visits(patient_id, n)]})
+
+@app.route('/records/search', methods=['GET'])
+def search_records():
+    """訪問記録の全文検索（?q=語&patient_id=利用者ID&limit=件数）"""
+    if record_store is None:
+        return jsonify({'error': '記録の保存が無効です'}), 404
+    records = record_store.search(request.args.get('q', ''), request.args.get('patient_id') or None,
+                                  request.args.get('limit', 20, type=int))
+    return jsonify({'records': [r.model_dump() for r in records]})
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    if result_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **result_cache.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus形式のメトリクス（段階ごとの所要時間・サイズ・トークン数のヒストグラム）"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/backends/stats', methods=['GET'])
+def backend_stats():
+    return jsonify({'transcribe': transcribe_router.stats(), 'report': report_router.stats()})
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Eventsで処理段階・文字起こし・生成途中のSOAPを配信"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+
+    def generate():
+        version = -1
+        sent_stage = None
+        sent_transcript = False
+        sent_report_len = 0
+        while True:
+            new_version = job.wait_for_update(version)
+            if new_version == version:
+                # 更新が無い間もコネクションを維持する
+                yield ": keep-alive\n\n"
+                continue
+            version = new_version
+            if job.transcript is not None and not sent_transcript:
+                sent_transcript = True
+                yield sse_event('transcript', {'transcript': job.transcript})
+            if job.stage != sent_stage and job.stage is not None:
+                sent_stage = job.stage
+                yield sse_event('stage', {'stage': job.stage})
+            report = job.report_partial
+            if len(report) != sent_report_len:
+                sent_report_len = len(report)
+                yield sse_event('report', {'report': report, 'sections': split_soap_sections(report)})
+            if job.finished:
+                if job.status == 'done':
+                    yield sse_event('done', {'report': job.report, 'timings': job.timings})
+                else:
+                    yield sse_event('error', {'error': f'処理中にエラーが発生しました: {job.error}'})
+                return
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
@@ -0,0 +1,245 @@
+import os
+import time
+import threading
+from loguru import logger
+from model_registry import registry
+
+# 文字起こし・レポート生成のバックエンド（api / local / fake）と切り替え設定
+TRANSCRIBE_BACKEND = os.environ.get("HOMECARE_TRANSCRIBE_BACKEND", "api")
+REPORT_BACKEND = os.environ.get("HOMECARE_REPORT_BACKEND", "api")
+# 主バックエンドが遅い・失敗するときの切り替え先（none で無効）。ロード済みのときだけ使う
+TRANSCRIBE_FALLBACK = os.environ.get("HOMECARE_TRANSCRIBE_FALLBACK", "local")
+REPORT_FALLBACK = os.environ.get("HOMECARE_REPORT_FALLBACK", "local")
+# 遅いとみなす所要時間（文字起こしは全体、レポートは最初のトークンまで）
+TRANSCRIBE_SLOW_SEC = float(os.environ.get("HOMECARE_TRANSCRIBE_SLOW_SEC", "60"))
+REPORT_SLOW_SEC = float(os.environ.get("HOMECARE_REPORT_SLOW_SEC", "10"))
+# サーキットブレーカー：連続失敗回数と、遮断してから主バックエンドを再試行するまでの秒数
+BREAKER_FAILURES = int(os.environ.get("HOMECARE_BREAKER_FAILURES", "3"))
+BREAKER_RESET_SEC = float(os.environ.get("HOMECARE_BREAKER_RESET_SEC", "60"))
+# 遅いと判定している間も、この間隔で主バックエンドに1件流して回復を確認する
+PROBE_SEC = float(os.environ.get("HOMECARE_BACKEND_PROBE_SEC", "30"))
+LATENCY_ALPHA = 0.3  # 所要時間の指数移動平均の重み
+
+
+class Backend:
+    """文字起こし（file_path -> str）またはレポート生成（transcript -> 差分のイテレータ）の実装"""
+
+    def __init__(self, name: str, model: str, fn, prompt_version: str = "", warm_model: str = None):
+        self.name = name
+        self.model = model  # キャッシュキーに使う
+        self.fn = fn
+        self.prompt_version = prompt_version
+        self.warm_model = warm_model  # ローカルモデルのレジストリ名
+
+    def is_warm(self) -> bool:
+        return self.warm_model is None or registry.is_loaded(self.warm_model)
+
+    def __repr__(self):
+        return f"Backend({self.name}, {self.model})"
+
+
+def create_backend(stage: str, name: str) -> Backend:
+    """stage（transcribe / report）とname（api / local / fake）からバックエンドを作る
+
+    選ばれたバックエンドのモジュールだけをインポートする（ローカルモデルはロード時に読み込む）。
+    """
+    if name == "fake":
+        from jobs import fake_transcribe, fake_report_stream
+        return Backend("fake", "fake", fake_transcribe if stage == "transcribe" else fake_report_stream, "fake")
+    if stage == "transcribe" and name == "api":
+        from make_text import transcribe_audio, TRANSCRIBE_MODEL
+        return Backend("api", TRANSCRIBE_MODEL, transcribe_audio)
+    if stage == "transcribe" and name == "local":
+        from make_text import transcribe_audio_local, WHISPER_MODEL_NAME
+        return Backend("local", WHISPER_MODEL_NAME, transcribe_audio_local, warm_model=WHISPER_MODEL_NAME)
+    if stage == "report" and name == "api":
+        from make_report import make_report_stream, REPORT_MODEL, REPORT_PROMPT_VERSION
+        return Backend("api", REPORT_MODEL, make_report_stream, REPORT_PROMPT_VERSION)
+    if stage == "report" and name == "local":
+        from make_report import make_report_local_stream, LOCAL_MODEL_NAME, REPORT_PROMPT_VERSION
+        return Backend("local", LOCAL_MODEL_NAME, make_report_local_stream, REPORT_PROMPT_VERSION,
+                       warm_model=LOCAL_MODEL_NAME)
+    raise ValueError(f"不明なバックエンドです: {stage}={name}")
+
+
+class CircuitBreaker:
+    """連続してfailures回失敗したら遮断し、reset_sec経過後に1件だけ試行を通す"""
+
+    def __init__(self, failures: int = BREAKER_FAILURES, reset_sec: float = BREAKER_RESET_SEC):
+        self.failures = failures
+        self.reset_sec = reset_sec
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at >= self.reset_sec:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._trial = False
+            if self.opened_at is not None or self.consecutive_failures >= self.failures:
+                self.opened_at = time.time()
+
+
+class BackendRouter:
+    """主バックエンドが遅い・遮断中のとき、ロード済みの代替バックエンドに振り分ける"""
+
+    def __init__(self, stage: str, primary: Backend, fallback: Backend = None,
+                 slow_sec: float = None, breaker: CircuitBreaker = None, probe_sec: float = PROBE_SEC):
+        self.stage = stage
+        self.primary = primary
+        self.fallback = fallback
+        self.slow_sec = slow_sec if slow_sec is not None else (
+            TRANSCRIBE_SLOW_SEC if stage == "transcribe" else REPORT_SLOW_SEC)
+        self.breaker = breaker or CircuitBreaker()
+        self.probe_sec = probe_sec
+        self.latency = {}  # バックエンド名 -> 所要時間の指数移動平均
+        self._last_primary = 0.0
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _stat(self, backend: Backend) -> dict:
+        return self._stats.setdefault(backend.name, {"calls": 0, "errors": 0, "failovers": 0})
+
+    def _fallback_ready(self) -> bool:
+        return self.fallback is not None and self.fallback.is_warm()
+
+    def _primary_slow(self) -> bool:
+        latency = self.latency.get(self.primary.name)
+        return latency is not None and latency > self.slow_sec
+
+    def choose(self) -> Backend:
+        if not self._fallback_ready():
+            return self.primary
+        with self._lock:
+            if self._primary_slow() and time.time() - self._last_primary < self.probe_sec:
+                return self.fallback
+        if not self.breaker.allow():
+            return self.fallback
+        with self._lock:
+            self._last_primary = time.time()
+        return self.primary
+
+    def _record(self, backend: Backend, elapsed: float = None, error: bool = False):
+        with self._lock:
+            stat = self._stat(backend)
+            stat["calls"] += 1
+            if error:
+                stat["errors"] += 1
+            elif elapsed is not None:
+                previous = self.latency.get(backend.name)
+                self.latency[backend.name] = elapsed if previous is None else (
+                    LATENCY_ALPHA * elapsed + (1 - LATENCY_ALPHA) * previous)
+        if backend is self.primary:
+            if error:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+
+    def _failover(self, backend: Backend, e: Exception) -> Backend:
+        """主バックエンドの失敗時に代替バックエンドを返す（使えなければ例外を再送出）"""
+        if backend is not self.primary or not self._fallback_ready():
+            raise e
+        with self._lock:
+            self._stat(self.fallback)["failovers"] += 1
+        logger.warning(f"{self.stage}: {self.primary.name}が失敗したため{self.fallback.name}に切り替えます ({type(e).__name__})")
+        return self.fallback
+
+    def run(self, *args):
+        """文字起こしなど結果を一度に返す処理を実行し、(使ったバックエンド, 結果)を返す"""
+        backend = self.choose()
+        while True:
+            start = time.perf_counter()
+            try:
+                result = backend.fn(*args)
+            except Exception as e:
+                self._record(backend, error=True)
+                backend = self._failover(backend, e)
+                continue
+            self._record(backend, time.perf_counter() - start)
+            return backend, result
+
+    def stream(self, *args) -> "RoutedStream":
+        """差分を返す処理を実行する（まだ何も出力していなければ失敗時に切り替える）"""
+        return RoutedStream(self, args)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "primary": self.primary.name,
+                "fallback": self.fallback.name if self.fallback else None,
+                "fallback_warm": self._fallback_ready(),
+                "breaker": self.breaker.state,
+                "latency_sec": {name: round(v, 3) for name, v in self.latency.items()},
+                "backends": {name: dict(s) for name, s in self._stats.items()},
+            }
+
+
+class RoutedStream:
+    """BackendRouter.stream()の戻り値。backendで実際に使ったバックエンドを参照できる"""
+
+    def __init__(self, router: BackendRouter, args):
+        self.router = router
+        self.args = args
+        self.backend = router.choose()
+
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            emitted = False
+            try:
+                for delta in self.backend.fn(*self.args):
+                    if not emitted:
+                        # レポートは最初のトークンまでの時間で遅さを判定する
+                        self.router._record(self.backend, time.perf_counter() - start)
+                        emitted = True
+                    yield delta
+            except Exception as e:
+                if emitted:
+                    raise
+                self.router._record(self.backend, error=True)
+                self.backend = self.router._failover(self.backend, e)
+                continue
+            if not emitted:
+                self.router._record(self.backend, time.perf_counter() - start)
+            return
+
+
+def create_router(stage: str, primary: str, fallback: str = None) -> BackendRouter:
+    primary_backend = create_backend(stage, primary)
+    fallback_backend = None
+    if fallback and fallback not in ("none", primary) and primary != "fake":
+        fallback_backend = create_backend(stage, fallback)
+    return BackendRouter(stage, primary_backend, fallback_backend)
+
+
+def configured_routers(fake: bool = False):
+    """環境変数の設定から(文字起こし, レポート生成)のルーターを作る"""
+    if fake:
+        return create_router("transcribe", "fake"), create_router("report", "fake")
+    return (create_router("transcribe", TRANSCRIBE_BACKEND, TRANSCRIBE_FALLBACK),
+            create_router("report", REPORT_BACKEND, REPORT_FALLBACK))
@@ -0,0 +1,220 @@
+import os
+import re
+import sys
+import json
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from loguru import logger
+from uploads import file_sha256
+from compaction import maybe_compact, compaction_version
+
+# 1日分の録音（または文字起こし）のディレクトリをまとめてSOAP記録にするオフライン処理
+AUDIO_EXTENSIONS = {".m4a", ".mp3", ".wav", ".mp4"}
+TRANSCRIPT_EXTENSIONS = {".txt"}
+# APIはスレッドで並列化（OpenAIの同時呼び出し数はopenai_client側でも制限される）
+API_WORKERS = int(os.environ.get("HOMECARE_BATCH_API_WORKERS", "4"))
+# ローカルモデルはプロセスごとにロードするのでメモリに合わせて少なめにする
+LOCAL_WORKERS = int(os.environ.get("HOMECARE_BATCH_LOCAL_WORKERS", "1"))
+# 1プロセスに同時に渡すファイル数。プロセス内のスレッドから同時に呼ぶことで、
+# local_report（HOMECARE_LOCAL_REPORT_BATCH_SIZE）とWhisperのマイクロバッチにまとめられる
+LOCAL_FILES_PER_WORKER = int(os.environ.get("HOMECARE_BATCH_LOCAL_FILES_PER_WORKER",
+                                            os.environ.get("HOMECARE_LOCAL_REPORT_BATCH_SIZE", "1")))
+
+_backends = {}  # ワーカー（プロセス）ごとに作ったバックエンド
+
+
+def _backend(stage: str, name: str):
+    from backends import create_backend
+    if (stage, name) not in _backends:
+        _backends[(stage, name)] = create_backend(stage, name)
+    return _backends[(stage, name)]
+
+
+def _slug(text: str) -> str:
+    return re.sub(r"[^0-9A-Za-z._-]+", "_", text)
+
+
+def find_inputs(input_dir: str) -> list:
+    """ディレクトリ直下の音声・文字起こしファイルを名前順に返す"""
+    paths = []
+    for name in sorted(os.listdir(input_dir)):
+        ext = os.path.splitext(name)[1].lower()
+        if ext in AUDIO_EXTENSIONS | TRANSCRIPT_EXTENSIONS:
+            paths.append(os.path.join(input_dir, name))
+    return paths
+
+
+class Checkpoint:
+    """入力ファイルのハッシュごとに、各段階の出力をファイルに保存する（再実行時はそこから再開する）"""
+
+    def __init__(self, out_dir: str, sha256: str):
+        self.dir = os.path.join(out_dir, "checkpoints", sha256[:16])
+
+    def _path(self, stage: str, key: str) -> str:
+        return os.path.join(self.dir, f"{stage}-{_slug(key)}.txt")
+
+    def load(self, stage: str, key: str):
+        path = self._path(stage, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def save(self, stage: str, key: str, text: str):
+        # 途中で落ちても壊れたチェックポイントが残らないよう一時ファイルから置き換える
+        os.makedirs(self.dir, exist_ok=True)
+        path = self._path(stage, key)
+        with open(path + ".part", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(path + ".part", path)
+
+
+def process_file(path: str, out_dir: str, transcribe_backend: str, report_backend: str) -> dict:
+    """1ファイルを文字起こし・レポート生成し、結果（JSONLの1行分）を返す。例外は結果のerrorに入れる"""
+    result = {"file": path, "status": "error", "resumed": [], "timings": {}, "error": None}
+    start = time.perf_counter()
+    try:
+        sha256 = file_sha256(path)
+        result["sha256"] = sha256
+        checkpoint = Checkpoint(out_dir, sha256)
+
+        if os.path.splitext(path)[1].lower() in TRANSCRIPT_EXTENSIONS:
+            with open(path, "r", encoding="utf-8") as f:
+                transcript = f.read()
+        else:
+            backend = _backend("transcribe", transcribe_backend)
+            transcript = checkpoint.load("transcript", backend.model)
+            if transcript is None:
+                stage_start = time.perf_counter()
+                transcript = backend.fn(path)
+                result["timings"]["transcribe"] = round(time.perf_counter() - stage_start, 3)
+                checkpoint.save("transcript", backend.model, transcript)
+            else:
+                result["resumed"].append("transcribe")
+        result["transcript"] = transcript
+
+        backend = _backend("report", report_backend)
+        key = f"{backend.model}-{backend.prompt_version}-{compaction_version()}"
+        report = checkpoint.load("report", key)
+        if report is None:
+            stage_start = time.perf_counter()
+            if backend.name == "local":
+                # ストリーミングしないので、同時に処理中のファイルとまとめて生成する版を使う
+                from make_report import make_report_local
+                report = make_report_local(maybe_compact(transcript))
+            else:
+                report = "".join(backend.fn(maybe_compact(transcript)))
+            result["timings"]["report"] = round(time.perf_counter() - stage_start, 3)
+            checkpoint.save("report", key, report)
+        else:
+            result["resumed"].append("report")
+        result["report"] = report
+        result["status"] = "done"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {str(e)}"
+        logger.error(f"{path}: {result['error']}")
+    result["timings"]["total"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def process_files(paths: list, out_dir: str, transcribe_backend: str, report_backend: str) -> list:
+    """ワーカープロセス内で複数のファイルをスレッドで同時に処理する（ローカルモデルのバッチ化のため）"""
+    with ThreadPoolExecutor(max_workers=len(paths), thread_name_prefix="homecare-batch") as executor:
+        return list(executor.map(lambda p: process_file(p, out_dir, transcribe_backend, report_backend), paths))
+
+
+def write_record(out_dir: str, result: dict) -> str:
+    """1訪問分のレポートをマークダウンで保存する"""
+    records_dir = os.path.join(out_dir, "records")
+    os.makedirs(records_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(result["file"]))[0]
+    path = os.path.join(records_dir, f"{name}.md")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"# {name}\n\n")
+        f.write(f"- 元ファイル: {os.path.basename(result['file'])}\n\n")
+        f.write(result["report"].strip() + "\n")
+    return path
+
+
+def make_executor(workers: int, use_processes: bool):
+    if use_processes:
+        # torchを読み込んだ親プロセスをforkしないようspawnで起動する
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="homecare-batch")
+
+
+def run_batch(input_dir: str, out_dir: str, transcribe_backend: str = "api", report_backend: str = "api",
+              workers: int = None) -> dict:
+    """input_dirの全ファイルを処理してout_dirにresults.jsonlとrecords/*.mdを書き、集計を返す
+
+    ローカルモデルを使う段階があればプロセスプール、APIだけならスレッドプールで並列化する。
+    """
+    use_processes = "local" in (transcribe_backend, report_backend)
+    workers = workers or (LOCAL_WORKERS if use_processes else API_WORKERS)
+    paths = find_inputs(input_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    logger.info(f"バッチ処理開始: {len(paths)}件, "
+                f"{'プロセス' if use_processes else 'スレッド'}×{workers}, "
+                f"文字起こし={transcribe_backend}, レポート={report_backend}")
+
+    summary = {"files": len(paths), "done": 0, "failed": 0, "resumed_stages": 0, "stage_sec": {}}
+    start = time.perf_counter()
+    with make_executor(workers, use_processes) as executor, \
+            open(os.path.join(out_dir, "results.jsonl"), "w", encoding="utf-8") as out:
+        if use_processes:
+            size = max(1, LOCAL_FILES_PER_WORKER)
+            futures = [executor.submit(process_files, paths[i:i + size], out_dir, transcribe_backend, report_backend)
+                       for i in range(0, len(paths), size)]
+        else:
+            futures = [executor.submit(process_file, p, out_dir, transcribe_backend, report_backend) for p in paths]
+        results = (r for future in as_completed(futures)
+                   for r in (future.result() if use_processes else [future.result()]))
+        for i, result in enumerate(results, 1):
+            if result["status"] == "done":
+                summary["done"] += 1
+                result["record"] = write_record(out_dir, result)
+            else:
+                summary["failed"] += 1
+            summary["resumed_stages"] += len(result["resumed"])
+            for stage, sec in result["timings"].items():
+                summary["stage_sec"][stage] = summary["stage_sec"].get(stage, 0.0) + sec
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            logger.info(f"[{i}/{len(paths)}] {os.path.basename(result['file'])}: {result['status']} "
+                        f"({result['timings']['total']:.2f}秒)")
+
+    wall = time.perf_counter() - start
+    summary["wall_sec"] = round(wall, 3)
+    summary["files_per_min"] = round(len(paths) / wall * 60, 2) if wall > 0 else None
+    summary["stage_sec"] = {k: round(v, 3) for k, v in summary["stage_sec"].items()}
+    return summary
+
+
+def _option(args: list, name: str, default=None):
+    if name in args:
+        i = args.index(name)
+        value = args[i + 1]
+        del args[i:i + 2]
+        return value
+    return default
+
+
+if __name__ == "__main__":
+    # python batch.py 入力ディレクトリ [出力ディレクトリ] [--transcribe api|local|fake] [--report api|local|fake]
+    #                 [--workers N]
+    # 同じ出力ディレクトリで再実行すると、完了済みの段階はチェックポイントから再開する
+    args = sys.argv[1:]
+    transcribe_backend = _option(args, "--transcribe", "api")
+    report_backend = _option(args, "--report", "api")
+    workers = _option(args, "--workers")
+    if not args:
+        sys.exit("使い方: python batch.py 入力ディレクトリ [出力ディレクトリ] [--transcribe ...] [--report ...] [--workers N]")
+    input_dir = args[0]
+    out_dir = args[1] if len(args) > 1 else os.path.join(input_dir, "batch_output")
+    summary = run_batch(input_dir, out_dir, transcribe_backend, report_backend, int(workers) if workers else None)
+    logger.success(f"バッチ処理完了: {summary}")
+    print(f"完了 {summary['done']}/{summary['files']}件, 失敗 {summary['failed']}件, "
+          f"チェックポイントから再開 {summary['resumed_stages']}段階, "
+          f"{summary['wall_sec']:.1f}秒 ({summary['files_per_min']}件/分)")
+    sys.exit(1 if summary["failed"] else 0)
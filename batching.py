@@ -0,0 +1,91 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from telemetry import span, batch_size, batch_wait_seconds, queue_depth
+
+
+class MicroBatcher:
+    """1件ずつの呼び出しを待ち行列に入れ、max_wait_ms以内に届いた分をまとめてbatch_fnで処理する
+
+    batch_fn(items) -> items と同じ順序の結果のリスト
+    """
+
+    def __init__(self, batch_fn, max_batch_size: int = 4, max_wait_ms: float = 50, name: str = "batch",
+                 workers: int = 1):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_sec = max_wait_ms / 1000
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {"batches": 0, "items": 0, "errors": 0, "wait_sec": 0.0, "run_sec": 0.0, "max_batch": 0}
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"homecare-{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        queue_depth.set(self._queue.qsize(), batcher=self.name)
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait_sec
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        queue_depth.set(self._queue.qsize(), batcher=self.name)
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _, _ in batch]
+            start = time.perf_counter()
+            batch_size.observe(len(batch), batcher=self.name)
+            for _, _, queued_at in batch:
+                batch_wait_seconds.observe(start - queued_at, batcher=self.name)
+            try:
+                with span(self.name, size=len(batch)):
+                    results = self.batch_fn(items)
+                error = None
+            except Exception as e:
+                results, error = None, e
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stat = self._stats
+                stat["batches"] += 1
+                stat["items"] += len(batch)
+                stat["errors"] += error is not None
+                stat["wait_sec"] += sum(start - queued_at for _, _, queued_at in batch)
+                stat["run_sec"] += elapsed
+                stat["max_batch"] = max(stat["max_batch"], len(batch))
+            for i, (_, future, _) in enumerate(batch):
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(results[i])
+
+    def stats(self) -> dict:
+        with self._lock:
+            stat = dict(self._stats)
+        items = stat["items"] or 1
+        return {
+            **stat,
+            "queue_depth": self._queue.qsize(),
+            "mean_batch_size": stat["items"] / stat["batches"] if stat["batches"] else 0.0,
+            "mean_wait_sec": stat["wait_sec"] / items,
+        }
@@ -0,0 +1,306 @@
+import os
+import sys
+import json
+import time
+import platform
+import numpy as np
+from loguru import logger
+from tokens import count_tokens, token_unit
+from telemetry import RssSampler
+from result_cache import text_sha256
+from uploads import file_sha256
+
+# 処理段階ごとのレイテンシ・スループット・メモリ・トークン数を計測するベンチマーク
+STAGES = ["decode", "transcribe", "structure", "restyle", "score"]
+# 既定では実行しない段階（--stagesで指定する）。compactは合成テキストの繰り返しを畳んで長さを揃えてしまうため
+OPTIONAL_STAGES = ["compact", "report"]
+NETWORK_STAGES = ["transcribe", "structure", "restyle", "report_api"]
+AUDIO_FILES = ["皮下点滴_田中一郎.m4a", "レコーディング.m4a"]
+SCRIPT_PATH = "script.txt"
+REFERENCE_PATH = "new_record.txt"
+SYNTHETIC_SCALES = (2, 4, 8)  # script.txtを繰り返して長い文字起こしを作る
+REGRESSION_TOLERANCE = 0.2
+
+
+def load_corpus(script_path: str = SCRIPT_PATH, audio_files=AUDIO_FILES, scales=SYNTHETIC_SCALES) -> dict:
+    """音声ファイルと、文字起こし（script.txtと長さを伸ばした合成テキスト）を読み込む"""
+    with open(script_path, "r") as f:
+        script = f.read().strip()
+    texts = [("script", script)] + [(f"synthetic_x{n}", "\n".join([script] * n)) for n in scales]
+    return {"audio": [p for p in audio_files if os.path.exists(p)], "text": texts}
+
+
+class RecordedResponses:
+    """ネットワークを使う段階の応答を入力のハッシュをキーに保存・再生する（オフライン実行用）"""
+
+    def __init__(self, path: str, mode: str):
+        self.path = path
+        self.mode = mode  # record / replay
+        self.data = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.data = json.load(f)
+        elif mode == "replay":
+            raise FileNotFoundError(f"録音した応答がありません: {path}")
+
+    @staticmethod
+    def _key(value: str) -> str:
+        return file_sha256(value) if os.path.isfile(value) else text_sha256(value)
+
+    def wrap(self, stage: str, fn):
+        def wrapped(value):
+            key = self._key(value)
+            if self.mode == "replay":
+                try:
+                    return self.data[stage][key]
+                except KeyError:
+                    raise KeyError(f"{stage}: 入力に対応する応答が録音されていません ({key[:12]})") from None
+            result = fn(value)
+            self.data.setdefault(stage, {})[key] = result
+            return result
+        return wrapped
+
+    def save(self):
+        if self.mode == "record":
+            with open(self.path, "w") as f:
+                json.dump(self.data, f, ensure_ascii=False, indent=2)
+            logger.info(f"応答を保存しました: {self.path}")
+
+
+def stage_functions(backend: str = "fake", transcribe_backend: str = None, responses: RecordedResponses = None,
+                    report_backends=()) -> dict:
+    """段階名 -> 関数。backendはネットワークを使う段階（fake / api / replay）、文字起こしはlocalも指定できる
+
+    report_backends（api / local / fake）はアプリと同じ1パスのレポート生成を report_<名前> の段階として測る。
+    """
+    functions = {}
+    if backend == "fake":
+        from jobs import fake_summary, fake_report
+        functions["structure"] = fake_summary
+        functions["restyle"] = fake_report
+    elif backend == "api":
+        from make_report import get_response
+        from con_repo import restyle_report, split_examples, record
+        # 出力例の検索は計測に含めないよう固定の出力例を使う
+        examples = "\n\n".join(split_examples(record))
+        functions["structure"] = get_response
+        functions["restyle"] = lambda response: restyle_report(response, examples)
+    elif backend != "replay":
+        raise ValueError(f"不明なバックエンドです: {backend}")
+
+    transcribe_backend = transcribe_backend or backend
+    if transcribe_backend != "replay":
+        from backends import create_backend
+        from model_registry import registry
+        transcriber = create_backend("transcribe", transcribe_backend)
+        # ローカルモデルのロードは計測から除外し、定常状態の実行時間を測る
+        if transcriber.warm_model:
+            registry.warmup([transcriber.warm_model])
+        functions["transcribe"] = transcriber.fn
+    for name in report_backends:
+        if name == "api" and responses is not None and responses.mode == "replay":
+            continue
+        from backends import create_backend
+        from model_registry import registry
+        reporter = create_backend("report", name)
+        if reporter.warm_model:
+            registry.warmup([reporter.warm_model])
+        functions[f"report_{name}"] = lambda transcript, fn=reporter.fn: "".join(fn(transcript))
+    if responses is not None:
+        for stage in NETWORK_STAGES:
+            if responses.mode == "replay" and stage not in functions:
+                functions[stage] = responses.wrap(stage, None)
+            elif responses.mode == "record" and stage in functions:
+                functions[stage] = responses.wrap(stage, functions[stage])
+
+    def decode(path):
+        from make_text import load_audio
+        return load_audio(path)
+
+    with open(REFERENCE_PATH, "r") as f:
+        reference = f.read()
+
+    def score(report):
+        from calcu import section_similarity
+        return section_similarity(report, reference)
+
+    from compaction import compact_transcript
+    functions["decode"] = decode
+    functions["compact"] = compact_transcript
+    functions["score"] = score
+    return functions
+
+
+class StageRecorder:
+    def __init__(self):
+        self.samples = {}
+
+    def run(self, stage: str, fn, value):
+        """fnを実行して所要時間・入出力トークン数・実行中のRSSの増加量を記録する
+
+        ru_maxrssは前の段階（モデルのロードなど）の最大値を引き継ぐため、段階ごとに現在のRSSを測る。
+        """
+        with RssSampler() as rss:
+            start = time.perf_counter()
+            result = fn(value)
+            elapsed = time.perf_counter() - start
+        sample = self.samples.setdefault(stage, {
+            "latencies": [], "input_tokens": 0, "output_tokens": 0, "rss_delta_mb": None,
+        })
+        sample["latencies"].append(elapsed)
+        if isinstance(value, str) and not os.path.isfile(value):
+            sample["input_tokens"] += count_tokens(value)
+        if isinstance(result, str):
+            sample["output_tokens"] += count_tokens(result)
+        if rss.delta_mb is not None:
+            sample["rss_delta_mb"] = max(sample["rss_delta_mb"] or 0.0, rss.delta_mb)
+        return result
+
+    def summary(self) -> dict:
+        result = {}
+        for stage, sample in self.samples.items():
+            latencies = np.array(sample["latencies"])
+            n = len(latencies)
+            result[stage] = {
+                "n": n,
+                "mean_sec": float(latencies.mean()),
+                "p50_sec": float(np.percentile(latencies, 50)),
+                "p95_sec": float(np.percentile(latencies, 95)),
+                "p99_sec": float(np.percentile(latencies, 99)),
+                "items_per_sec": n / float(latencies.sum()) if latencies.sum() > 0 else None,
+                "rss_delta_mb": round(sample["rss_delta_mb"], 1) if sample["rss_delta_mb"] is not None else None,
+                "input_tokens_per_item": sample["input_tokens"] / n,
+                "output_tokens_per_item": sample["output_tokens"] / n,
+            }
+        return result
+
+
+def run_benchmark(iterations: int = 3, stages=STAGES, backend: str = "fake", transcribe_backend: str = None,
+                  responses: RecordedResponses = None, corpus: dict = None, report_backends=(),
+                  text_from_audio: bool = False) -> dict:
+    """コーパス全体をiterations回処理し、段階ごとの集計を返す
+
+    text_from_audio=Trueなら、テキストの段階はコーパスの文字起こしではなくその回に文字起こしした結果で測る。
+    """
+    corpus = corpus or load_corpus()
+    report_backends = report_backends if "report" in stages else ()
+    functions = stage_functions(backend, transcribe_backend, responses, report_backends)
+    recorder = StageRecorder()
+    start = time.perf_counter()
+    for i in range(iterations):
+        logger.info(f"ベンチマーク {i + 1}/{iterations}")
+        texts = corpus["text"]
+        if text_from_audio:
+            texts = []
+        for path in corpus["audio"]:
+            if "decode" in stages:
+                recorder.run("decode", functions["decode"], path)
+            if "transcribe" in stages:
+                transcript = recorder.run("transcribe", functions["transcribe"], path)
+                if text_from_audio:
+                    texts.append((os.path.basename(path), transcript))
+        for _, text in texts:
+            if "compact" in stages:
+                text = recorder.run("compact", functions["compact"], text)
+            structured = report = text
+            if "structure" in stages:
+                structured = recorder.run("structure", functions["structure"], text)
+            reports = []
+            if "restyle" in stages:
+                reports.append(recorder.run("restyle", functions["restyle"], structured))
+            for name in report_backends:
+                reports.append(recorder.run(f"report_{name}", functions[f"report_{name}"], text))
+            if "score" in stages:
+                for report in reports or [report]:
+                    recorder.run("score", functions["score"], report)
+    if responses is not None:
+        responses.save()
+    return {
+        "meta": {
+            "created_at": time.time(),
+            "iterations": iterations,
+            "backend": backend,
+            "transcribe_backend": transcribe_backend or backend,
+            "report_backends": list(report_backends),
+            "audio_files": corpus["audio"],
+            "texts": ["(文字起こし結果)"] if text_from_audio else [name for name, _ in corpus["text"]],
+            "wall_sec": time.perf_counter() - start,
+            # *_tokens_per_itemの単位（tiktokenが無い環境では文字数）
+            "token_unit": token_unit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "stages": recorder.summary(),
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE) -> list:
+    """基準値よりtolerance以上悪化した指標を返す"""
+    regressions = []
+    for stage, current in result["stages"].items():
+        base = baseline.get("stages", {}).get(stage)
+        if base is None:
+            continue
+        for metric in ("p50_sec", "p95_sec", "p99_sec", "rss_delta_mb",
+                       "input_tokens_per_item", "output_tokens_per_item"):
+            if base.get(metric) and current.get(metric) is not None \
+                    and current[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{stage}.{metric}: {base[metric]:.3f} -> {current[metric]:.3f}")
+        if base.get("items_per_sec") and current["items_per_sec"] is not None \
+                and current["items_per_sec"] < base["items_per_sec"] * (1 - tolerance):
+            regressions.append(f"{stage}.items_per_sec: {base['items_per_sec']:.3f} -> {current['items_per_sec']:.3f}")
+    return regressions
+
+
+def _option(args: list, name: str, default=None):
+    if name in args:
+        i = args.index(name)
+        value = args[i + 1]
+        del args[i:i + 2]
+        return value
+    return default
+
+
+if __name__ == "__main__":
+    # python bench.py run [結果.json] [--iterations N] [--stages decode,transcribe,...（compact・reportは指定時のみ）]
+    #                     [--backend fake|api] [--transcribe api|local|fake] [--report api,local,fake]
+    #                     [--record 応答.json | --replay 応答.json]
+    # python bench.py compare 結果.json 基準.json [--tolerance 0.2]
+    args = sys.argv[1:]
+    command = args.pop(0) if args else "run"
+    if command == "compare":
+        tolerance = float(_option(args, "--tolerance", REGRESSION_TOLERANCE))
+        with open(args[0], "r") as f:
+            result = json.load(f)
+        with open(args[1], "r") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, tolerance)
+        for regression in regressions:
+            logger.error(f"性能低下: {regression}")
+        if not regressions:
+            logger.success("基準からの性能低下はありません")
+        sys.exit(1 if regressions else 0)
+
+    iterations = int(_option(args, "--iterations", "3"))
+    stages = _option(args, "--stages", ",".join(STAGES)).split(",")
+    backend = _option(args, "--backend", "fake")
+    transcribe_backend = _option(args, "--transcribe")
+    report_backends = [n for n in _option(args, "--report", "").split(",") if n]
+    if report_backends and "report" not in stages:
+        stages.append("report")
+    responses = None
+    record_path = _option(args, "--record")
+    replay_path = _option(args, "--replay")
+    if replay_path:
+        backend = "replay"
+        transcribe_backend = transcribe_backend or "replay"
+        responses = RecordedResponses(replay_path, "replay")
+    elif record_path:
+        responses = RecordedResponses(record_path, "record")
+    result = run_benchmark(iterations, stages, backend, transcribe_backend, responses, report_backends=report_backends)
+    for stage, summary in result["stages"].items():
+        logger.success(f"{stage}: {summary}")
+    output_path = args[0] if args else "bench.json"
+    with open(output_path, "w") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    logger.info(f"結果を保存しました: {output_path}")
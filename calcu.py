@@ -1,6 +1,14 @@
+import sys
+import csv
+import json
+import time
+import hashlib
+from collections import OrderedDict
+import numpy as np
 from sentence_transformers import SentenceTransformer, util
 from loguru import logger
 from bleu import list_bleu
+from soap import split_soap_sections, SECTION_NAMES
 
 # モデルのロード
 model = SentenceTransformer('stsb-xlm-r-multilingual')
@@ -10,10 +18,14 @@ model.max_seq_length = 512
 first = model._first_module()
 tok = first.tokenizer
 
+def token_lengths(texts) -> list:
+    """まとめて1回だけトークナイズし、各文のトークン数（特殊トークン込み）を返す"""
+    return [len(ids) for ids in tok(list(texts), add_special_tokens=True, truncation=False)["input_ids"]]
+
 def is_truncated(s: str):
-    ids_full = tok.encode(s, add_special_tokens=True, truncation=False)
-    ids_trunc = tok.encode(s, add_special_tokens=True, truncation=True, max_length=model.get_max_seq_length())
-    return len(ids_full) > len(ids_trunc), len(ids_full), len(ids_trunc)
+    tokens_full = token_lengths([s])[0]
+    tokens_used = min(tokens_full, model.get_max_seq_length())
+    return tokens_full > tokens_used, tokens_full, tokens_used
 
 def log_truncation_status(name: str, s: str):
     truncated, tokens_full, tokens_used = is_truncated(s)
@@ -21,27 +33,190 @@ def log_truncation_status(name: str, s: str):
 
 def calc_similarity(sentence1, sentence2):
     # 文章をベクトルに変換（事前に切り捨てチェックしてログ）
-    tr1 = log_truncation_status("sentence1", sentence1)
-    tr2 = log_truncation_status("sentence2", sentence2)
-    if tr1 or tr2:
+    if any(n > model.get_max_seq_length() for n in token_lengths([sentence1, sentence2])):
         logger.warning("トークン切り捨てが発生しました。")
 
-    # コサイン類似度の計算
-    embeddings1 = model.encode(sentence1, convert_to_tensor=True)
-    embeddings2 = model.encode(sentence2, convert_to_tensor=True)
-
-    cosine_score = util.pytorch_cos_sim(embeddings1, embeddings2)[0][0]
+    # コサイン類似度の計算（2文をまとめてエンコード）
+    embeddings = model.encode([sentence1, sentence2], convert_to_tensor=True)
 
-    # SentenceTransformer内部のトークナイザを取得
-    first = model._first_module()
-    tok = first.tokenizer
+    cosine_score = util.pytorch_cos_sim(embeddings[0], embeddings[1])[0][0]
     return cosine_score
 
+# 同じ文章（参照記録など）を何度もエンコードしないためのキャッシュ
+EMBEDDING_CACHE_SIZE = 10000
+_embedding_cache = OrderedDict()
+
+def encode_cached(texts, batch_size: int = 32) -> np.ndarray:
+    """未キャッシュの文章だけを1回のバッチでエンコードし、正規化済みベクトルを返す"""
+    keys = [hashlib.sha256(t.encode("utf-8")).hexdigest() for t in texts]
+    if not keys:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    missing = list(dict.fromkeys(k for k in keys if k not in _embedding_cache))
+    if missing:
+        text_by_key = dict(zip(keys, texts))
+        vectors = model.encode([text_by_key[k] for k in missing], batch_size=batch_size,
+                               convert_to_numpy=True, normalize_embeddings=True)
+        for k, v in zip(missing, vectors):
+            _embedding_cache[k] = v
+    result = np.stack([_embedding_cache[k] for k in keys])
+    for k in keys:
+        _embedding_cache.move_to_end(k)
+    while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+        _embedding_cache.popitem(last=False)
+    return result
+
+def chunk_report(text: str) -> list:
+    """レポートを## S/O/A/P/Summaryの見出しで分け、長いセクションはトークン窓で分割する"""
+    sections = split_soap_sections(text) or {"全文": text.strip()}
+    window = model.get_max_seq_length() - 2  # 特殊トークンの分を除く
+    chunks = []
+    for name, body in sections.items():
+        if not body:
+            continue
+        ids = tok(body, add_special_tokens=False)["input_ids"]
+        if len(ids) <= window:
+            chunks.append((name, body))
+            continue
+        for start in range(0, len(ids), window):
+            chunks.append((name, tok.decode(ids[start:start + window])))
+    return chunks
+
+def _normalize(v: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(v)
+    return v / norm if norm else v
+
+def section_embeddings(texts) -> list:
+    """全テキストのチャンクを1回のバッチでエンコードし、セクションごとの平均ベクトルを返す"""
+    chunked = [chunk_report(t) for t in texts]
+    vectors = encode_cached([c for chunks in chunked for _, c in chunks])
+    results = []
+    pos = 0
+    for chunks in chunked:
+        by_section = {}
+        for name, _ in chunks:
+            by_section.setdefault(name, []).append(vectors[pos])
+            pos += 1
+        sections = {name: _normalize(np.mean(vs, axis=0)) for name, vs in by_section.items()}
+        document = _normalize(np.mean([v for vs in by_section.values() for v in vs], axis=0)) if by_section else None
+        results.append({"sections": sections, "document": document})
+    return results
+
+def _compare_sections(hyp: dict, ref: dict) -> dict:
+    common = [name for name in SECTION_NAMES + ["全文"] if name in hyp["sections"] and name in ref["sections"]]
+    scores = {name: float(hyp["sections"][name] @ ref["sections"][name]) for name in common}
+    return {
+        "sections": scores,
+        # 両方にあるセクションの類似度の平均と、全チャンク平均ベクトル同士の類似度
+        "pooled": float(np.mean(list(scores.values()))) if scores else None,
+        "document": float(hyp["document"] @ ref["document"])
+        if hyp["document"] is not None and ref["document"] is not None else None,
+    }
+
+def section_similarity(hypothesis: str, reference: str) -> dict:
+    """切り捨てなしのセクション別類似度と全体のスコアを返す"""
+    hyp, ref = section_embeddings([hypothesis, reference])
+    return _compare_sections(hyp, ref)
+
+def section_similarity_many(hypotheses, reference: str) -> list:
+    """1つの参照記録と複数の生成記録を比較する（参照記録のチャンクは1回だけエンコード）"""
+    embedded = section_embeddings([reference] + list(hypotheses))
+    return [_compare_sections(hyp, embedded[0]) for hyp in embedded[1:]]
+
+def load_pairs(path: str) -> list:
+    """JSONL（1行に {"hypothesis": ..., "reference": ...}）を読み込む"""
+    pairs = []
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                pairs.append((row["hypothesis"], row["reference"]))
+    return pairs
+
+def evaluate_pairs(pairs, batch_size: int = 32, sections: bool = False) -> dict:
+    """(生成記録, 看護師の記録)のペアをまとめて評価する"""
+    start = time.perf_counter()
+    pairs = list(pairs)
+    if not pairs:
+        # 空の入力はモデルを呼ばずに空の結果を返す
+        summary = {"pairs": 0, "cosine_mean": None, "cosine_min": None, "best_match_rate": None, "truncated": 0,
+                   "section_pooled_mean": None, "bleu": None, "elapsed_sec": time.perf_counter() - start}
+        logger.warning("評価するペアがありません")
+        return {"summary": summary, "rows": []}
+    hyps = [h for h, _ in pairs]
+    refs = [r for _, r in pairs]
+
+    # 切り捨て判定は全文をまとめて1回だけトークナイズ
+    max_len = model.get_max_seq_length()
+    lengths = token_lengths(hyps + refs)
+    hyp_lengths, ref_lengths = lengths[:len(hyps)], lengths[len(hyps):]
+
+    # 全文を1回のバッチでエンコードし、コサイン類似度行列を行列積で計算
+    vectors = encode_cached(hyps + refs, batch_size)
+    cos_matrix = vectors[:len(hyps)] @ vectors[len(hyps):].T
+    scores = np.diag(cos_matrix)
+    # 各生成記録が自分の参照記録と最も近いか（取り違えの検出用）
+    best_match = np.argmax(cos_matrix, axis=1) == np.arange(len(hyps))
+
+    # BLEUはコーパス全体で1回だけ計算
+    bleu = list_bleu([[normalize_for_bleu(r) for r in refs]], [normalize_for_bleu(h) for h in hyps])
+
+    rows = [
+        {
+            "index": i,
+            "cosine": float(scores[i]),
+            "best_match": bool(best_match[i]),
+            "hypothesis_tokens": hyp_lengths[i],
+            "reference_tokens": ref_lengths[i],
+            "truncated": hyp_lengths[i] > max_len or ref_lengths[i] > max_len,
+        }
+        for i in range(len(pairs))
+    ]
+    if sections:
+        # セクション別の類似度（長い記録も切り捨てずに評価）
+        embedded = section_embeddings(hyps + refs)
+        for i, row in enumerate(rows):
+            result = _compare_sections(embedded[i], embedded[len(hyps) + i])
+            row["section_pooled"] = result["pooled"]
+            row["section_document"] = result["document"]
+            for name in SECTION_NAMES:
+                row[f"section_{name}"] = result["sections"].get(name)
+    summary = {
+        "pairs": len(pairs),
+        "cosine_mean": float(np.mean(scores)) if len(pairs) else None,
+        "cosine_min": float(np.min(scores)) if len(pairs) else None,
+        "best_match_rate": float(np.mean(best_match)) if len(pairs) else None,
+        "truncated": sum(r["truncated"] for r in rows),
+        "section_pooled_mean": float(np.mean([r["section_pooled"] for r in rows if r["section_pooled"] is not None]))
+        if sections and any(r["section_pooled"] is not None for r in rows) else None,
+        "bleu": bleu,
+        "elapsed_sec": time.perf_counter() - start,
+    }
+    logger.success(f"評価結果: {summary}")
+    return {"summary": summary, "rows": rows}
+
+def write_results(result: dict, csv_path: str = None, json_path: str = None):
+    if csv_path:
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(result["rows"][0].keys()) if result["rows"] else ["index"])
+            writer.writeheader()
+            writer.writerows(result["rows"])
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
 def normalize_for_bleu(t: str) -> str:
     # 改行や余分な空白を潰して1行化
     return " ".join(ln.strip() for ln in t.splitlines() if ln.strip())
 
 if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "eval":
+        # python calcu.py eval pairs.jsonl [結果.csv] [要約.json] [--sections]
+        args = [a for a in sys.argv[2:] if a != "--sections"]
+        result = evaluate_pairs(load_pairs(args[0]), sections="--sections" in sys.argv)
+        write_results(result, args[1] if len(args) > 1 else None,
+                      args[2] if len(args) > 2 else None)
+        sys.exit(0)
+
     # 比較する文章
     sentence1 = """
 ## S
@@ -92,6 +267,7 @@ SpO2は酸素送気なしで90％台後半を示しており、発熱などの
 
     similarity = calc_similarity(sentence1, sentence2)
     logger.success(f"文章1と文章2の類似度: {similarity}")
+    logger.success(f"セクション別の類似度: {section_similarity(sentence1, sentence2)}")
 
     ref = normalize_for_bleu(sentence2)
     hyp = normalize_for_bleu(sentence1)
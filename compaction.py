@@ -0,0 +1,146 @@
+import os
+import re
+from loguru import logger
+from tokens import count_tokens, token_unit
+
+# レポート生成の前に文字起こしを圧縮する（フィラー・繰り返しの除去、空白の整理、トークン数の上限）
+# calc_similarityへの影響を確認するまでは既定で無効（python compaction.py --reports で比較する）
+COMPACT_TRANSCRIPT = os.environ.get("HOMECARE_COMPACT_TRANSCRIPT", "0") == "1"
+TRANSCRIPT_TOKEN_BUDGET = int(os.environ.get("HOMECARE_TRANSCRIPT_TOKEN_BUDGET", "12000"))  # 0で無制限
+DEDUPE_WINDOW = 20  # 直前の何文までを重複の判定に使うか
+SHORT_SENTENCE_CHARS = 8  # 上限を超えたときに先に削る相づち程度の短い文
+OMISSION_MARK = "（中略）"
+
+# 伸ばし音付きの間投詞と笑い声。「あの人」「まあまあ」のような語は残すため伸ばし音があるものだけを対象にし、
+# 「始めまーす」「ええとても」のような語の一部を削らないよう、前後が文頭・文末・句読点・空白のときだけ除く
+_BOUNDARY = r"\s、。，,．！？!?「」"
+_FILLER_RE = re.compile(
+    rf"(?<![^{_BOUNDARY}])"
+    r"(?:え[ーぇ〜~]+(?:っと|と)?|えっと|ええと|あの[ーぉ〜~]+|その[ーぉ〜~]+|う[ーぅ〜~]+ん|ん[ーん〜~]+"
+    r"|あ[ーぁ〜~]+|ま[ーぁ〜~]+|[ふはへ]{3,})"
+    rf"(?=[{_BOUNDARY}]|$)[、,]?"
+)
+# Whisperがループしたときなどの、同じ言い回しの連続した繰り返し（6～80文字の単位）
+_REPEAT_RE = re.compile(r"(.{6,80}?)\1+")
+_SENTENCE_RE = re.compile(r"(?<=[。！？!?\n])")
+
+
+def _normalize(sentence: str) -> str:
+    return re.sub(r"[\s、。，,．.！？!?]", "", sentence)
+
+
+def _split_sentences(text: str) -> list:
+    return [s for s in _SENTENCE_RE.split(text) if s.strip()]
+
+
+def remove_fillers(text: str) -> str:
+    text = _FILLER_RE.sub("", text)
+    # フィラーを除いた跡に残る読点を整理する
+    text = re.sub(r"[、,]{2,}", "、", text)
+    text = re.sub(r"。{2,}", "。", text)
+    return re.sub(r"(^|[。！？!?\n])\s*[、,]+", r"\1", text)
+
+
+def collapse_whitespace(text: str) -> str:
+    text = re.sub(r"[ \t　]+", " ", text)
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def remove_repeats(text: str) -> str:
+    """連続した同じ言い回しを1回にし、直前DEDUPE_WINDOW文以内と同じ文を除く"""
+    text = _REPEAT_RE.sub(r"\1", text)
+    kept, recent = [], []
+    for sentence in _split_sentences(text):
+        key = _normalize(sentence)
+        if key and key in recent:
+            continue
+        kept.append(sentence)
+        if key:
+            recent = (recent + [key])[-DEDUPE_WINDOW:]
+    return "".join(kept)
+
+
+def fit_budget(text: str, token_budget: int) -> str:
+    """トークン数が上限を超えていれば、短い文から削り、それでも超える分は中間を省略する（実測で判定）"""
+    if token_budget <= 0 or count_tokens(text) <= token_budget:
+        return text
+    sentences = _split_sentences(text)
+    drop = set()
+    total = count_tokens(text)
+    for i in sorted((i for i, s in enumerate(sentences) if len(_normalize(s)) < SHORT_SENTENCE_CHARS),
+                    key=lambda i: len(sentences[i])):
+        if total <= token_budget:
+            break
+        drop.add(i)
+        total -= count_tokens(sentences[i])
+    text = "".join(s for i, s in enumerate(sentences) if i not in drop)
+    tokens = count_tokens(text)
+    if tokens <= token_budget:
+        return text
+    # 冒頭（バイタルなど）と終盤（今後の予定）を残し、中間を省略する
+    keep_chars = int(len(text) * (token_budget - count_tokens(OMISSION_MARK)) / tokens)
+    while keep_chars > 0:
+        head = keep_chars // 2
+        candidate = text[:head] + OMISSION_MARK + text[len(text) - (keep_chars - head):]
+        if count_tokens(candidate) <= token_budget:
+            return candidate
+        keep_chars = int(keep_chars * 0.95)
+    return OMISSION_MARK
+
+
+def compact_transcript(text: str, token_budget: int = TRANSCRIPT_TOKEN_BUDGET) -> str:
+    """フィラー・繰り返しを除いて空白を整理し、トークン数をtoken_budget以下にする"""
+    compacted = fit_budget(remove_repeats(collapse_whitespace(remove_fillers(text))), token_budget)
+    before, after = count_tokens(text), count_tokens(compacted)
+    logger.info(f"文字起こしの圧縮: {before} -> {after} ({token_unit()}) ({len(text)} -> {len(compacted)}文字)")
+    return compacted
+
+
+def maybe_compact(text: str) -> str:
+    """HOMECARE_COMPACT_TRANSCRIPT=0なら文字起こしをそのまま返す"""
+    return compact_transcript(text) if COMPACT_TRANSCRIPT else text
+
+
+def compaction_version() -> str:
+    """キャッシュ・チェックポイントのキーに含める圧縮設定"""
+    return f"compact{TRANSCRIPT_TOKEN_BUDGET}" if COMPACT_TRANSCRIPT else "raw"
+
+
+def benchmark(samples: list, reference: str = None) -> dict:
+    """サンプルごとの圧縮前後のトークン数と、referenceがあればレポートの類似度（calc_similarity）を比べる
+
+    samples: (名前, 文字起こし) のリスト。referenceを渡すとmake_reportを圧縮前・後で1回ずつ呼ぶ。
+    """
+    results = {}
+    for name, text in samples:
+        compacted = compact_transcript(text)
+        before, after = count_tokens(text), count_tokens(compacted)
+        result = {"token_unit": token_unit(), "tokens_before": before, "tokens_after": after,
+                  "saved_ratio": round(1 - after / before, 3) if before else 0.0}
+        if reference is not None:
+            from make_report import make_report
+            from calcu import calc_similarity
+            result["similarity_raw"] = round(float(calc_similarity(make_report(text), reference)), 4)
+            result["similarity_compacted"] = round(float(calc_similarity(make_report(compacted), reference)), 4)
+        results[name] = result
+        logger.success(f"{name}: {result}")
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    # python compaction.py [文字起こし.txt ...] [--reports] : 実際の文字起こし（既定はscript.txt）で圧縮率を計測する
+    # 合成テキスト（script.txtの繰り返し）は重複として畳まれるだけなので使わない
+    # --reports を付けるとAPIでレポートを生成し、new_record.txtとの類似度を圧縮前後で比べる
+    from bench import SCRIPT_PATH, REFERENCE_PATH
+    args = sys.argv[1:]
+    reference = None
+    if "--reports" in args:
+        args.remove("--reports")
+        with open(REFERENCE_PATH, "r") as f:
+            reference = f.read()
+    samples = []
+    for path in [a for a in args if a != "bench"] or [SCRIPT_PATH]:
+        with open(path, "r") as f:
+            samples.append((os.path.basename(path), f.read()))
+    benchmark(samples, reference)
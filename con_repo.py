@@ -1,8 +1,19 @@
-from make_report import get_response
+import os
+import re
+import sys
+import time
+from make_report import get_response, HomecareSummary
 from make_text import transcribe_audio_local
 from loguru import logger
-from openai import OpenAI
-import os
+import openai_client
+from soap import render_soap_markdown
+from tokens import count_tokens
+
+# 1パス生成で出力例に使うトークン数の上限
+EXAMPLE_TOKEN_BUDGET = int(os.environ.get("HOMECARE_EXAMPLE_TOKEN_BUDGET", "1500"))
+# 出力例は全件ではなく文字起こしに近い上位k件だけを使う（HOMECARE_EXEMPLAR_RETRIEVAL=0で全件）
+EXEMPLAR_RETRIEVAL = os.environ.get("HOMECARE_EXEMPLAR_RETRIEVAL", "1") == "1"
+EXEMPLAR_K = int(os.environ.get("HOMECARE_EXEMPLAR_K", "3"))
 
 
 record = """
@@ -106,16 +117,12 @@ record = """
 def make_report(transcript: str) -> str:
     response = get_response(transcript)
     logger.success(f"response: {response}")
-    # report = HomecareSummary.model_validate_json(response)
-    # past_record_path = "./records.txt"
-    
-    #try:
-    #    with open(past_record_path, "r") as f:
-    #         past_record = f.read()
-    # except FileNotFoundError:
-    #     past_record = ""
-        
-    client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+    examples = "\n\n".join(select_examples(transcript))
+    return restyle_report(response, examples)
+
+def restyle_report(response: str, examples: str) -> str:
+    """get_responseの構造化出力を出力例の文体の看護記録に書き直す（make_reportの2パス目）"""
+    client = openai_client.get_client()
     prompt = f"""
     ## 指示
     以下の"## AI出力"の内容を看護記録としてSOAP形式でまとめてください。
@@ -132,9 +139,11 @@ def make_report(transcript: str) -> str:
     {response}
 
     ## 出力例
-    {record}
+    {examples}
     """
-    response = client.chat.completions.create(
+    response = openai_client.call(
+        "con_repo.make_report",
+        client.chat.completions.create,
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "あなたは訪問看護の記録作成支援AIです。"},
@@ -145,7 +154,118 @@ def make_report(transcript: str) -> str:
     logger.info(f"new_record: {type(new_record)}")
     return str(new_record)
 
+def split_examples(text: str) -> list:
+    """出力例を症例ごと（'## S'の見出し単位）に分割する"""
+    return [e.strip() for e in re.split(r"\n\s*\n+(?=## S\s*\n)", text.strip()) if e.strip()]
+
+
+def select_examples(transcript: str, k: int = EXEMPLAR_K) -> list:
+    """出力例ストアから文字起こしに類似した記録を取得する（ストアが空なら固定の出力例を使う）"""
+    if EXEMPLAR_RETRIEVAL:
+        from exemplar_store import get_store
+        examples = get_store().search(transcript, k)
+        if examples:
+            return examples
+    return split_examples(record)
+
+
+def trim_examples(examples: list, budget: int = EXAMPLE_TOKEN_BUDGET) -> list:
+    """先頭から順にトークン数の上限に収まるだけ出力例を残す（最低1件）"""
+    kept = []
+    used = 0
+    for example in examples:
+        tokens = count_tokens(example)
+        if kept and used + tokens > budget:
+            break
+        kept.append(example)
+        used += tokens
+    logger.info(f"出力例: {len(kept)}/{len(examples)}件, {used}トークン")
+    return kept
+
+
+def make_summary_one_pass(transcript: str, example_budget: int = EXAMPLE_TOKEN_BUDGET) -> HomecareSummary:
+    """文字起こしから1回の構造化出力でHomecareSummaryを生成する"""
+    examples = "\n\n".join(trim_examples(select_examples(transcript), example_budget))
+    client = openai_client.get_client()
+    prompt = f"""
+    ## 指示
+    以下の"## 会話文字起こし"の内容から、訪問看護の看護記録をSOAP形式で作成してください。
+
+    ## 制約条件
+    - 適宜専門的な用語を使用してください。
+    - 文体・粒度は"## 出力例"を参考にしてください（出力例は複数の症例です）。
+    - summary: 要約（SOAPの内容を3～5行程度の文章にまとめる）
+    - subjects: 主観情報（利用者の発言）
+    - objects: 客観情報（観察所見・処置内容を箇条書き）
+    - assessments: 評価（看護上の解釈・問題点。明確な訴えが無ければ「なし」）
+    - plans: 計画（今後の対応や指導、観察継続点）
+
+    ## 出力例
+    {examples}
+
+    ## 会話文字起こし
+    {transcript}
+    """
+    response = openai_client.call(
+        "con_repo.make_summary_one_pass",
+        client.beta.chat.completions.parse,
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": "あなたは訪問看護の記録作成支援AIです。"},
+            {"role": "user", "content": prompt}
+        ],
+        response_format=HomecareSummary
+    )
+    message = response.choices[0].message
+    if message.parsed is not None:
+        return message.parsed
+    if getattr(message, "refusal", None):
+        raise ValueError(f"構造化出力を取得できませんでした: {message.refusal}")
+    return HomecareSummary.model_validate_json(message.content)
+
+
+def make_report_one_pass(transcript: str, example_budget: int = EXAMPLE_TOKEN_BUDGET) -> str:
+    """make_reportの1パス版。構造化出力をローカルでマークダウンに整形する"""
+    return render_soap_markdown(make_summary_one_pass(transcript, example_budget))
+
+
+def _token_totals() -> dict:
+    stats = openai_client.stats()
+    return {
+        "prompt_tokens": sum(s["prompt_tokens"] for s in stats.values()),
+        "completion_tokens": sum(s["completion_tokens"] for s in stats.values()),
+    }
+
+
+def benchmark(transcript: str, iterations: int = 3) -> dict:
+    """2パス（make_report）と1パス（make_report_one_pass）のレイテンシとトークン数を比較する"""
+    results = {}
+    for mode, fn in [("two_pass", make_report), ("one_pass", make_report_one_pass)]:
+        before = _token_totals()
+        latencies = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            fn(transcript)
+            latencies.append(time.perf_counter() - start)
+        after = _token_totals()
+        results[mode] = {
+            "mean_sec": sum(latencies) / len(latencies),
+            "max_sec": max(latencies),
+            "prompt_tokens": (after["prompt_tokens"] - before["prompt_tokens"]) / iterations,
+            "completion_tokens": (after["completion_tokens"] - before["completion_tokens"]) / iterations,
+        }
+        logger.success(f"{mode}: {results[mode]}")
+    return results
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        # python con_repo.py bench [iterations]
+        with open("script.txt", "r") as f:
+            transcript = f.read()
+        benchmark(transcript, int(sys.argv[2]) if len(sys.argv) > 2 else 3)
+        sys.exit(0)
+
     transcript = transcribe_audio_local("./皮下点滴_田中一郎.m4a")
     logger.success(f"transcript: {transcript}")
     report = make_report(transcript)
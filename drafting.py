@@ -0,0 +1,323 @@
+import os
+import time
+import hashlib
+import threading
+from loguru import logger
+import openai_client
+from make_report import HomecareSummary, REPORT_MODEL, build_soap_prompt, prior_section, log_stream_timing
+from make_text import ChunkConfig, iter_transcript_chunks, merge_overlap
+from soap import render_soap_markdown
+from telemetry import in_context
+
+# 文字起こしのチャンクが届くたびにSOAPの下書きを更新し、最後は下書きの仕上げだけを行う（HOMECARE_PIPELINE=1）
+PIPELINE_CHUNK_SEC = float(os.environ.get("HOMECARE_PIPELINE_CHUNK_SEC", "120"))  # 下書きを早く始めるため短めに分割
+DRAFT_MODEL = os.environ.get("HOMECARE_DRAFT_MODEL", "gpt-4o-mini")  # 下書きの更新は軽いモデルで行う
+# 1: 最後にGPTで全体を書き直す（遅いが文章が整う） 0: 下書きをローカルでマークダウンに整形する
+PIPELINE_POLISH = os.environ.get("HOMECARE_PIPELINE_POLISH", "0") == "1"
+
+
+def build_extend_prompt(draft: HomecareSummary, segment: str) -> str:
+    current = draft.model_dump_json(indent=1) if draft is not None else "（まだありません）"
+    return f"""
+    ## 指示
+    訪問看護の会話を先頭から順に文字起こししています。"## 続きの会話文字起こし"から、
+    "## これまでの下書き"に無い情報だけを看護記録の項目として抽出してください。
+
+    ## 制約条件
+    - 適宜専門的な用語を使用してください。
+    - 下書きにすでにある内容は出力しないでください（追加する項目が無ければ空のリスト）。
+    - summary: 要約（下書きと続きの内容を合わせた全体を3～5行程度で）
+    - subjects: 追加する主観情報（利用者の発言）
+    - objects: 追加する客観情報（観察所見・処置内容）
+    - assessments: 追加する評価（看護上の解釈・問題点）
+    - plans: 追加する計画（今後の対応や指導、観察継続点）
+
+    ## これまでの下書き
+    {current}
+
+    ## 続きの会話文字起こし
+    {segment}
+    """
+
+
+def build_polish_prompt(draft: HomecareSummary, tail: str, prior: str = "") -> str:
+    return f"""
+    ## 指示
+    以下の"## 下書き"は訪問看護の会話から作成したSOAP形式の看護記録の下書きです。
+    "## 続きの会話文字起こし"があればその内容も反映し、重複を整理して看護記録として仕上げてください。
+
+    ## 制約条件
+    - 適宜専門的な用語を使用してください。
+    - マークダウン形式で出力してください。
+    - SummaryはSOAP形式で記載した内容を文章にまとめてください。
+
+    ## 出力形式
+    ## S
+    -XXX
+    -XXX
+    ## O
+    -XXX
+    -XXX
+    ## A
+    -XXX
+    -XXX
+    ## P
+    -XXX
+    -XXX
+    ------------------------
+    ## Summary
+    XXX
+
+    {prior_section(prior)}## 下書き
+    {render_soap_markdown(draft)}
+
+    ## 続きの会話文字起こし
+    {tail.strip() or "なし"}
+    """
+
+
+DRAFT_PROMPT_VERSION = hashlib.sha256(
+    (build_extend_prompt(None, "") + build_polish_prompt(HomecareSummary(summary="", objects=[], plans=[]), "")).encode("utf-8")
+).hexdigest()[:12]
+
+
+def cache_identity(polish: bool = PIPELINE_POLISH) -> tuple:
+    """パイプライン版のレポートをキャッシュするときの(モデル, プロンプトの版)
+
+    下書きはDRAFT_MODELで作るため、通常のレポート（REPORT_MODEL）とは別のキーにする。
+    """
+    model = f"{DRAFT_MODEL}+{REPORT_MODEL}" if polish else DRAFT_MODEL
+    return model, f"{DRAFT_PROMPT_VERSION}:{'polish' if polish else 'render'}"
+
+
+def merge_draft(draft: HomecareSummary, update: HomecareSummary) -> HomecareSummary:
+    """追加分の項目を下書きの末尾に足し、要約は新しいものに置き換える"""
+    if draft is None:
+        return update
+    return HomecareSummary(
+        summary=update.summary or draft.summary,
+        subjects=(draft.subjects or []) + (update.subjects or []),
+        objects=draft.objects + update.objects,
+        assessments=(draft.assessments or []) + (update.assessments or []),
+        plans=draft.plans + update.plans,
+    )
+
+
+def extend_draft(draft: HomecareSummary, segment: str) -> HomecareSummary:
+    """続きの文字起こしから追加分だけを生成し、下書きに反映する（出力は追加分の長さで済む）"""
+    client = openai_client.get_client()
+    response = openai_client.call(
+        "extend_draft",
+        client.beta.chat.completions.parse,
+        model=DRAFT_MODEL,
+        messages=[
+            {"role": "system", "content": "あなたは訪問看護の記録作成支援AIです。"},
+            {"role": "user", "content": build_extend_prompt(draft, segment)}
+        ],
+        response_format=HomecareSummary
+    )
+    message = response.choices[0].message
+    update = message.parsed if message.parsed is not None else HomecareSummary.model_validate_json(message.content)
+    return merge_draft(draft, update)
+
+
+def polish_report_stream(draft: HomecareSummary, tail: str, prior: str = ""):
+    """下書きと未反映の文字起こしからレポートを仕上げ、差分を順にyieldする（下書きが無ければ通常の生成）"""
+    start = time.perf_counter()
+    prompt = build_polish_prompt(draft, tail, prior) if draft is not None else build_soap_prompt(tail, prior)
+    client = openai_client.get_client()
+    stream = openai_client.call(
+        "polish_report",
+        client.chat.completions.create,
+        model=REPORT_MODEL,
+        messages=[
+            {"role": "system", "content": "あなたは訪問看護の記録作成支援AIです。"},
+            {"role": "user", "content": prompt}
+        ],
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+
+    def deltas():
+        with stream:
+            for chunk in stream:
+                openai_client.record_usage("polish_report", chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    yield from log_stream_timing("polish_report", deltas(), start)
+
+
+class SoapDrafter:
+    """届いた文字起こしを連結しつつ、別スレッドで下書きを順に更新する
+
+    更新中に届いたチャンクはまとめて次の更新に回す。finish()は実行中の更新だけを待ち、
+    まだ下書きに反映していない文字起こし（tail）を返す。
+    """
+
+    def __init__(self, extend_fn=extend_draft):
+        self.extend_fn = extend_fn
+        self.transcript = ""
+        self.draft = None
+        self.updates = 0
+        self.error = None
+        self._pending = []
+        self._closed = False
+        self._busy = False
+        self._cond = threading.Condition()
+        # 下書き更新のAPI呼び出しのスパンもジョブのトレースに入るようにする
+        self._thread = threading.Thread(target=in_context(self._worker), name="homecare-drafter", daemon=True)
+        self._thread.start()
+
+    def add(self, text: str):
+        with self._cond:
+            previous = self.transcript
+            self.transcript = merge_overlap(previous, text) if previous else text.strip()
+            # 前のチャンクとの重複を除いた新しい部分だけを下書きに回す
+            self._pending.append(self.transcript[len(previous):])
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or (self._pending and self.error is None))
+                if self._closed:
+                    return
+                segment = "".join(self._pending)
+                self._pending = []
+                self._busy = True
+                draft = self.draft
+            start = time.perf_counter()
+            try:
+                draft = self.extend_fn(draft, segment)
+                error = None
+            except Exception as e:
+                error = e
+                logger.warning(f"下書きの更新に失敗しました。以降は最後にまとめて生成します: {str(e)}")
+            with self._cond:
+                if error is None:
+                    self.draft = draft
+                    self.updates += 1
+                    logger.info(f"下書き更新 {self.updates}回目: {len(segment)}文字, {time.perf_counter() - start:.2f}秒")
+                else:
+                    # 失敗した分は未反映のまま残す
+                    self.error = error
+                    self._pending.insert(0, segment)
+                self._busy = False
+                self._cond.notify_all()
+
+    def finish(self):
+        """(下書き, 下書きに未反映の文字起こし)を返す"""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._busy)
+            self._closed = True
+            self._cond.notify_all()
+            tail = "".join(self._pending)
+            self._pending = []
+            return self.draft, tail
+
+
+def draft_while_transcribing(chunks, extend_fn=extend_draft):
+    """文字起こしのチャンク（先頭から順）を受け取りながら下書きを作り、(全文, 下書き, tail)を返す"""
+    drafter = SoapDrafter(extend_fn)
+    for text in chunks:
+        drafter.add(text)
+    draft, tail = drafter.finish()
+    logger.info(f"下書き: {drafter.updates}回更新, 未反映 {len(tail)}文字")
+    return drafter.transcript, draft, tail
+
+
+def should_pipeline(file_path: str) -> bool:
+    # 分割して文字起こしする長さのファイルだけをパイプライン化する
+    return os.path.getsize(file_path) > ChunkConfig().chunked_min_bytes
+
+
+def pipelined_transcribe(file_path: str, backend: str = "api"):
+    """短めのチャンクで文字起こししながら下書きを更新し、(全文, 下書き, tail)を返す"""
+    return draft_while_transcribing(iter_transcript_chunks(file_path, backend, chunk_sec=PIPELINE_CHUNK_SEC))
+
+
+def finish_report_stream(draft: HomecareSummary, tail: str, extend_fn=extend_draft, polish: bool = PIPELINE_POLISH,
+                         prior: str = ""):
+    """未反映の文字起こしを1回の短い呼び出しで下書きに反映し、レポートの差分をyieldする
+
+    過去の記録（prior）があれば、それを踏まえるよう仕上げの呼び出しを行う。
+    """
+    if polish or draft is None or prior:
+        yield from polish_report_stream(draft, tail, prior)
+        return
+    if tail.strip():
+        try:
+            draft = extend_fn(draft, tail)
+        except Exception as e:
+            logger.warning(f"下書きの更新に失敗したため全体を書き直します: {str(e)}")
+            yield from polish_report_stream(draft, tail, prior)
+            return
+    yield render_soap_markdown(draft)
+
+
+def benchmark(transcript: str, n_chunks: int = 10, concurrency: int = 4, scale: float = 0.01) -> dict:
+    """逐次処理とパイプライン処理の所要時間を、録音済みの文字起こしと遅延モデル付きのダミー応答で比較する
+
+    1回のAPI呼び出しの遅延は 固定分 + 入力文字数・出力文字数に比例する分 とし、scale倍して待つ。
+    看護記録の出力は会話の1/3程度の長さとみなす。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def call_latency(input_chars: int, output_chars: int) -> float:
+        return (1.0 + input_chars * 0.002 + output_chars * 0.02) * scale
+
+    step = max(1, len(transcript) // n_chunks)
+    segments = [transcript[i:i + step] for i in range(0, len(transcript), step)]
+
+    def fake_transcribe_chunk(segment):
+        time.sleep(call_latency(0, len(segment)))
+        return segment
+
+    def fake_extend(draft, segment):
+        lines = [l for l in segment.splitlines() if l.strip()]
+        update = HomecareSummary(summary="ダミーの要約です。", objects=[l[:30] for l in lines[::3]], plans=[])
+        current = len(draft.model_dump_json()) if draft is not None else 0
+        time.sleep(call_latency(current + len(segment), len(update.model_dump_json())))
+        return merge_draft(draft, update)
+
+    def chunks():
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            yield from executor.map(fake_transcribe_chunk, segments)
+
+    start = time.perf_counter()
+    full = "".join(chunks())
+    transcribe_sec = time.perf_counter() - start
+    # 逐次：全文がそろってから1回でレポートを生成する
+    time.sleep(call_latency(len(full), len(full) // 3))
+    sequential_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    full, draft, tail = draft_while_transcribing(chunks(), fake_extend)
+    finish_start = time.perf_counter()
+    report = "".join(finish_report_stream(draft, tail, extend_fn=fake_extend, polish=False))
+    finish_sec = time.perf_counter() - finish_start
+    pipelined_sec = time.perf_counter() - start
+
+    result = {
+        "chunks": len(segments),
+        "transcribe_sec": round(transcribe_sec, 3),
+        "sequential_sec": round(sequential_sec, 3),
+        "pipelined_sec": round(pipelined_sec, 3),
+        "pipelined_after_transcribe_sec": round(pipelined_sec - transcribe_sec, 3),
+        "final_call_sec": round(finish_sec, 3),
+        "tail_chars": len(tail),
+        "report_chars": len(report),
+    }
+    logger.success(f"パイプライン比較: {result}")
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+    # python drafting.py bench [チャンク数] [倍率] : script.txtを繰り返した長い文字起こしで比較する
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        with open("script.txt", "r") as f:
+            transcript = "\n".join([f.read().strip()] * 4)
+        benchmark(transcript, int(sys.argv[2]) if len(sys.argv) > 2 else 10,
+                  scale=float(sys.argv[3]) if len(sys.argv) > 3 else 0.01)
@@ -0,0 +1,56 @@
+import os
+import threading
+from sentence_transformers import SentenceTransformer
+from loguru import logger
+from vector_index import VectorIndex
+from soap import split_dated_records
+
+# 過去のSOAP記録（出力例）を埋め込んでおき、文字起こしに近いものだけをプロンプトに入れる
+EXEMPLAR_DB_PATH = os.environ.get("HOMECARE_EXEMPLAR_DB", "exemplars.db")
+EXEMPLAR_INDEX_PATH = os.environ.get("HOMECARE_EXEMPLAR_INDEX", "exemplars.faiss")
+EXEMPLAR_MODEL_NAME = os.environ.get(
+    "HOMECARE_EXEMPLAR_MODEL", "sentence-transformers/paraphrase-xlm-r-multilingual-v1"
+)
+
+
+class ExemplarStore:
+    def __init__(self, db_path: str = EXEMPLAR_DB_PATH, index_path: str = EXEMPLAR_INDEX_PATH,
+                 model_name: str = EXEMPLAR_MODEL_NAME):
+        self.index = VectorIndex(db_path, index_path, SentenceTransformer(model_name), table="exemplars")
+
+    def add(self, texts) -> int:
+        """未登録の記録だけを埋め込んで追加する（追加件数を返す）"""
+        return len(self.index.add(texts))
+
+    def search(self, transcript: str, k: int = 3) -> list:
+        """文字起こしに近い順に出力例のテキストを返す"""
+        return [text for _, _, text in self.index.search([transcript], k)[0]]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> ExemplarStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ExemplarStore()
+    return _store
+
+
+if __name__ == "__main__":
+    # 既存の出力例（con_repo.record、records.txt、new_record.txt）を登録する
+    from con_repo import record, split_examples
+
+    texts = split_examples(record)
+    with open("records.txt", "r") as f:
+        texts += split_dated_records(f.read())
+    with open("new_record.txt", "r") as f:
+        texts.append(f.read())
+    store = get_store()
+    store.add(texts)
+    with open("script.txt", "r") as f:
+        for example in store.search(f.read(), k=2):
+            logger.info(f"類似した出力例:\n{example}")
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from telemetry import span, trace
+
+# ジョブ実行設定（環境変数で上書き可能）
+MAX_WORKERS = int(os.environ.get("HOMECARE_MAX_WORKERS", "4"))  # 同時処理数
+MAX_PENDING = int(os.environ.get("HOMECARE_MAX_PENDING", "100"))  # 待ち行列の上限
+JOB_TTL_SEC = int(os.environ.get("HOMECARE_JOB_TTL_SEC", "3600"))  # 完了ジョブの保持時間
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, file_path: str, sha256: str = None, patient_id: str = None):
+        self.id = uuid.uuid4().hex
+        self.file_path = file_path
+        self.sha256 = sha256
+        self.patient_id = patient_id  # 指定されていれば訪問記録として保存する
+        self.record_id = None
+        self.status = "queued"  # queued / running / done / error
+        self.stage = None
+        self.timings = {}
+        self.transcript = None
+        self.report = None
+        self.error = None
+        self.cache = {}  # 段階ごとのキャッシュ hit / miss
+        self.backends = {}  # 段階ごとに実際に使ったバックエンド
+        self.created_at = time.time()
+        self.finished_at = None
+        # SSE配信用：生成途中のレポートと更新通知
+        self.report_partial = ""
+        self.version = 0
+        self._updated = threading.Condition()
+
+    def notify(self):
+        with self._updated:
+            self.version += 1
+            self._updated.notify_all()
+
+    def append_report(self, delta: str):
+        self.report_partial += delta
+        self.notify()
+
+    def wait_for_update(self, version: int, timeout: float = 15.0) -> int:
+        """versionより新しい更新があるまで待ち、現在のversionを返す"""
+        with self._updated:
+            self._updated.wait_for(lambda: self.version != version, timeout=timeout)
+            return self.version
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "error")
+
+    @contextmanager
+    def stage_timer(self, name: str):
+        """処理段階の名前と所要時間を記録する"""
+        self.stage = name
+        self.notify()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - start, 3)
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "timings": self.timings,
+            "cache": self.cache,
+            "backends": self.backends,
+            "patient_id": self.patient_id,
+            "record_id": self.record_id,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+@contextmanager
+def stage_timer(job, name: str):
+    """スパンとして計測し、jobがあれば段階ごとの時間も記録する（jobがNoneなのは同期実行）"""
+    with span(name):
+        if job is None:
+            yield
+        else:
+            with job.stage_timer(name):
+                yield
+
+
+class JobManager:
+    def __init__(self, pipeline, max_workers: int = MAX_WORKERS, max_pending: int = MAX_PENDING,
+                 cleanup: bool = True):
+        # pipeline(file_path, job) -> (transcript, report)
+        self.pipeline = pipeline
+        self.max_pending = max_pending
+        self.cleanup = cleanup
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="homecare-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, file_path: str, sha256: str = None, patient_id: str = None) -> Job:
+        with self._lock:
+            self._evict_expired()
+            pending = sum(1 for j in self._jobs.values() if j.status in ("queued", "running"))
+            if pending >= self.max_pending:
+                raise QueueFullError(f"待ち行列が上限({self.max_pending})に達しています")
+            job = Job(file_path, sha256, patient_id)
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job)
+        logger.info(f"job {job.id} 登録: {file_path}")
+        return job
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: Job):
+        # ジョブ内のスパンにはジョブIDをトレースIDとして付ける
+        with trace(job.id), span("job"):
+            self._run_traced(job)
+
+    def _run_traced(self, job: Job):
+        job.status = "running"
+        start = time.perf_counter()
+        status = "error"
+        try:
+            job.transcript, job.report = self.pipeline(job.file_path, job)
+            status = "done"
+        except Exception as e:
+            job.error = str(e)
+            logger.error(f"job {job.id} エラー: {str(e)}")
+            logger.error(f"エラーの詳細: {traceback.format_exc()}")
+        finally:
+            if self.cleanup:
+                with stage_timer(job, "cleanup"):
+                    if os.path.exists(job.file_path):
+                        os.remove(job.file_path)
+            job.timings["total"] = round(time.perf_counter() - start, 3)
+            job.stage = None
+            job.finished_at = time.time()
+            # 完了扱いにするのは計測・後処理がすべて終わってから
+            job.status = status
+            job.notify()
+            logger.info(f"job {job.id} 終了: {job.status} ({job.timings['total']:.2f}秒)")
+
+    def _evict_expired(self):
+        now = time.time()
+        expired = [
+            job_id for job_id, j in self._jobs.items()
+            if j.finished_at is not None and now - j.finished_at > JOB_TTL_SEC
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+# ローカル動作確認用のダミー文字起こし・レポート生成
+FAKE_DELAY_SEC = float(os.environ.get("HOMECARE_FAKE_DELAY_SEC", "0.5"))
+
+
+def fake_transcribe(file_path: str) -> str:
+    time.sleep(FAKE_DELAY_SEC)
+    return f"（ダミー文字起こし）{os.path.basename(file_path)} の会話内容です。SpO2は98％でした。"
+
+
+def fake_analyze_image_detail(img_path) -> dict:
+    time.sleep(FAKE_DELAY_SEC)
+    return {
+        "img_path": img_path,
+        "result": "（ダミー画像解析）褥瘡（ステージII）の可能性があります。",
+        "original_bytes": os.path.getsize(img_path),
+        "bytes_sent": os.path.getsize(img_path),
+        "base64_bytes": (os.path.getsize(img_path) + 2) // 3 * 4,
+        "latency_sec": FAKE_DELAY_SEC,
+    }
+
+
+def fake_summary(transcript: str) -> str:
+    """get_responseのダミー（HomecareSummaryのJSON）"""
+    time.sleep(FAKE_DELAY_SEC)
+    return json.dumps({
+        "summary": "ダミーの要約です。",
+        "subjects": [transcript[:50]],
+        "objects": ["SpO2 98％"],
+        "assessments": ["特記事項なし"],
+        "plans": ["経過観察を継続する"],
+    }, ensure_ascii=False)
+
+
+def fake_report(transcript: str, prior: str = "") -> str:
+    time.sleep(FAKE_DELAY_SEC)
+    return "".join(fake_report_stream(transcript, prior, delay=0))
+
+
+def fake_report_stream(transcript: str, prior: str = "", delay: float = None):
+    report = f"""## S
+- {transcript}
+## O
+- SpO2 98％
+## A
+- 特記事項なし
+## P
+- 経過観察を継続する
+------------------------
+## Summary
+ダミーのレポートです。
+"""
+    lines = report.splitlines(keepends=True)
+    delay = FAKE_DELAY_SEC / len(lines) if delay is None else delay
+    for line in lines:
+        time.sleep(delay)
+        yield line
@@ -0,0 +1,262 @@
+from threading import Thread, Lock
+import os
+import copy
+import time
+import queue
+import torch
+from loguru import logger
+from transformers import TextStreamer, TextIteratorStreamer, DynamicCache
+import accelerate
+from batching import MicroBatcher
+from telemetry import in_context, RssSampler
+from model_registry import registry
+from make_report import LOCAL_MODEL_NAME, build_soap_prompt, log_stream_timing
+
+# ローカルLLM（Tanuki-8B）によるレポート生成。transformers/torchを読み込むため必要なときだけimportする
+SYSTEM_PROMPT = "以下は、タスクを説明する指示です。要求を適切に満たす応答を書きなさい。"
+GENERATION_KWARGS = dict(
+    do_sample=True,
+    max_new_tokens=int(os.environ.get("HOMECARE_LOCAL_MAX_NEW_TOKENS", "512")),
+    temperature=0.5,
+)
+# 文字起こしより前の固定部分（システムプロンプト・指示）のKVキャッシュを使い回す
+PREFIX_CACHE = os.environ.get("HOMECARE_LOCAL_PREFIX_CACHE", "1") == "1"
+# make_report_localを同時に呼ばれたとき、まとめて1回のgenerateにする件数と待ち時間
+LOCAL_BATCH_SIZE = int(os.environ.get("HOMECARE_LOCAL_REPORT_BATCH_SIZE", "1"))
+LOCAL_BATCH_WAIT_MS = float(os.environ.get("HOMECARE_LOCAL_REPORT_BATCH_WAIT_MS", "200"))
+# ストリーミング生成で次のトークンを待つ上限（超えたら失敗として代替バックエンドに切り替えられるようにする）
+LOCAL_STREAM_TIMEOUT_SEC = float(os.environ.get("HOMECARE_LOCAL_STREAM_TIMEOUT_SEC", "300"))
+_TRANSCRIPT_MARKER = "<<TRANSCRIPT>>"
+
+
+def quantize_model(model, mode: str):
+    """CPU向けに重みを量子化する（int8: torchの動的量子化、int4: optimum-quanto）"""
+    start = time.perf_counter()
+    if mode == "int8":
+        # bfloat16のまま置き換える（inplace=Falseだとモデル全体を複製する）。動的量子化のLinearは
+        # float32の入力・バイアスを受け取るので、量子化後に残りの層（埋め込み・正規化）をfloat32にする
+        for module in model.modules():
+            if isinstance(module, torch.nn.Linear) and module.bias is not None:
+                module.bias.data = module.bias.data.float()
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        model = model.float()
+    elif mode == "int4":
+        try:
+            from optimum.quanto import quantize, freeze, qint4
+        except ImportError:
+            raise ImportError("int4量子化には optimum-quanto が必要です（pip install optimum-quanto）") from None
+        quantize(model, weights=qint4)
+        freeze(model)
+    else:
+        raise ValueError(f"不明な量子化の指定です: {mode}")
+    logger.info(f"{mode}量子化: {time.perf_counter() - start:.2f}秒")
+    return model
+
+
+def build_messages(transcript: str, prior: str = "") -> list:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": build_soap_prompt(transcript, prior)}
+    ]
+
+
+def render_prompt(tokenizer, transcript: str, prior: str = "") -> str:
+    return tokenizer.apply_chat_template(build_messages(transcript, prior), add_generation_prompt=True,
+                                         tokenize=False)
+
+
+def encode_prompt(tokenizer, transcript: str, prior: str = "") -> torch.Tensor:
+    # テンプレートを文字列にしてからトークナイズする（接頭辞のトークン列と揃えるため）
+    return tokenizer(render_prompt(tokenizer, transcript, prior), add_special_tokens=False,
+                     return_tensors="pt").input_ids
+
+
+class PrefixCache:
+    """固定の接頭辞のKVキャッシュを1度だけ計算し、リクエストごとに複製して使う"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._model_id = None
+        self.ids = None
+        self.cache = None
+
+    def _build(self, model, tokenizer):
+        prefix = render_prompt(tokenizer, _TRANSCRIPT_MARKER).split(_TRANSCRIPT_MARKER)[0]
+        self.ids = tokenizer(prefix, add_special_tokens=False, return_tensors="pt").input_ids.to(model.device)
+        start = time.perf_counter()
+        with torch.no_grad():
+            self.cache = model(self.ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+        self._model_id = id(model)
+        logger.info(f"接頭辞のKVキャッシュを作成しました（{self.ids.shape[1]}トークン, {time.perf_counter() - start:.2f}秒）")
+
+    def for_input(self, model, tokenizer, input_ids: torch.Tensor):
+        """input_idsと先頭が一致する分だけのKVキャッシュの複製を返す（一致しなければNone）"""
+        with self._lock:
+            # モデルが解放・再ロードされたら作り直す
+            if self._model_id != id(model):
+                self._build(model, tokenizer)
+            n = min(self.ids.shape[1], input_ids.shape[1] - 1)
+            matches = (self.ids[0, :n] == input_ids[0, :n]).tolist()
+            common = matches.index(False) if False in matches else n
+            if common == 0:
+                return None
+            cache = copy.deepcopy(self.cache)
+        if common < cache.get_seq_length():
+            cache.crop(common)
+        return cache
+
+
+_prefix_cache = PrefixCache()
+
+
+def _prepare(model, tokenizer, transcript: str, prior: str = "") -> dict:
+    # 過去の記録の節は文字起こしの前に入るので、接頭辞キャッシュは一致する先頭部分だけが使われる
+    input_ids = encode_prompt(tokenizer, transcript, prior).to(model.device)
+    inputs = dict(inputs=input_ids, attention_mask=torch.ones_like(input_ids))
+    if PREFIX_CACHE:
+        cache = _prefix_cache.for_input(model, tokenizer, input_ids)
+        if cache is not None:
+            inputs["past_key_values"] = cache
+    return inputs
+
+
+def _generate_single(transcript: str, prior: str = "") -> str:
+    model, tokenizer = registry.get(LOCAL_MODEL_NAME)  # 初回のみロードし以降は使い回す
+    streamer = TextStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    inputs = _prepare(model, tokenizer, transcript, prior)
+    with torch.no_grad():
+        output_ids = model.generate(**inputs, streamer=streamer, pad_token_id=tokenizer.pad_token_id,
+                                    **GENERATION_KWARGS)
+
+    # 生成されたテキストをデコード
+    generated_text = tokenizer.decode(output_ids[0][inputs["inputs"].shape[1]:], skip_special_tokens=True)
+    logger.info(f"Generated text: {len(generated_text)}文字")
+    return generated_text
+
+
+def make_reports_local_batch(transcripts: list, priors: list = None) -> list:
+    """複数の文字起こしを左パディングして1回のgenerateでまとめて生成する（priorsは文字起こしごとの過去の記録）"""
+    priors = priors or [""] * len(transcripts)
+    if len(transcripts) == 1:
+        return [_generate_single(transcripts[0], priors[0])]
+    model, tokenizer = registry.get(LOCAL_MODEL_NAME)
+    texts = [render_prompt(tokenizer, t, p) for t, p in zip(transcripts, priors)]
+    inputs = tokenizer(texts, add_special_tokens=False, padding=True, return_tensors="pt").to(model.device)
+    with torch.no_grad():
+        output_ids = model.generate(**inputs, pad_token_id=tokenizer.pad_token_id, **GENERATION_KWARGS)
+    prompt_len = inputs.input_ids.shape[1]
+    return [tokenizer.decode(o[prompt_len:], skip_special_tokens=True) for o in output_ids]
+
+
+def _generate_batch(requests: list) -> list:
+    """マイクロバッチの(文字起こし, 過去の記録)のリストをまとめて生成する"""
+    return make_reports_local_batch([t for t, _ in requests], [p for _, p in requests])
+
+
+_batcher = None
+_batcher_lock = Lock()
+
+
+def get_batcher() -> MicroBatcher:
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = MicroBatcher(_generate_batch, LOCAL_BATCH_SIZE, LOCAL_BATCH_WAIT_MS,
+                                        name="local-report")
+    return _batcher
+
+
+def make_report_local(transcript: str, prior: str = "") -> str:
+    if LOCAL_BATCH_SIZE > 1:
+        # 同時に届いた文字起こしとまとめて生成する
+        return get_batcher()((transcript, prior))
+    return _generate_single(transcript, prior)
+
+def make_report_local_stream(transcript: str, prior: str = ""):
+    """make_report_localのストリーミング版。generateを別スレッドで回して差分をyieldする"""
+    model, tokenizer = registry.get(LOCAL_MODEL_NAME)  # 初回のみロードし以降は使い回す
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True,
+                                    timeout=LOCAL_STREAM_TIMEOUT_SEC)
+
+    start = time.perf_counter()
+    inputs = _prepare(model, tokenizer, transcript, prior)
+    errors = []
+
+    def generate():
+        try:
+            with torch.no_grad():
+                model.generate(**inputs, streamer=streamer, pad_token_id=tokenizer.pad_token_id,
+                               **GENERATION_KWARGS)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # 例外で終わっても読み出し側が待ち続けないよう終了を通知する
+            streamer.end()
+
+    def deltas():
+        try:
+            for text in streamer:
+                if text:
+                    yield text
+        except queue.Empty:
+            raise TimeoutError(f"ローカルLLMの生成が{LOCAL_STREAM_TIMEOUT_SEC:.0f}秒以上進みませんでした")
+        if errors:
+            raise errors[0]
+
+    thread = Thread(target=in_context(generate), daemon=True)
+    thread.start()
+    yield from log_stream_timing("make_report_local_stream", deltas(), start)
+    thread.join()
+
+
+def benchmark(transcripts: list) -> dict:
+    """逐次（接頭辞キャッシュなし/あり）とバッチ生成のトークン/秒と、実行中のRSSの増加量を比較する"""
+    global PREFIX_CACHE
+    model, tokenizer = registry.get(LOCAL_MODEL_NAME)
+
+    def count_new_tokens(texts):
+        return sum(len(tokenizer(t, add_special_tokens=False).input_ids) for t in texts)
+
+    def run(name, fn):
+        # ru_maxrssは前のモードの最大値を引き継ぐので、実行中の現在のRSSを測って増加量を比べる
+        with RssSampler() as rss:
+            start = time.perf_counter()
+            outputs = fn()
+            elapsed = time.perf_counter() - start
+        tokens = count_new_tokens(outputs)
+        result = {
+            "sec": round(elapsed, 2),
+            "new_tokens": tokens,
+            "tokens_per_sec": round(tokens / elapsed, 2),
+            "rss_start_mb": round(rss.start_mb) if rss.start_mb is not None else None,
+            "rss_delta_mb": round(rss.delta_mb) if rss.delta_mb is not None else None,
+        }
+        logger.success(f"{name}: {result}")
+        return result
+
+    prefix_cache = PREFIX_CACHE
+    results = {"quantization": os.environ.get("HOMECARE_LOCAL_QUANTIZATION", "none")}
+    try:
+        PREFIX_CACHE = False
+        results["sequential"] = run("sequential", lambda: [_generate_single(t) for t in transcripts])
+        PREFIX_CACHE = True
+        results["prefix_cache"] = run("prefix_cache", lambda: [_generate_single(t) for t in transcripts])
+    finally:
+        PREFIX_CACHE = prefix_cache
+    results["batch"] = run("batch", lambda: make_reports_local_batch(transcripts))
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    # python local_report.py bench [件数] : 量子化は HOMECARE_LOCAL_QUANTIZATION=int8 などで切り替えて比較する
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+        with open("script.txt", "r") as f:
+            script = f.read()
+        # 長さの異なる文字起こしを用意する
+        lines = script.splitlines()
+        transcripts = ["\n".join(lines[: max(1, len(lines) * (i + 1) // n)]) for i in range(n)]
+        registry.warmup([LOCAL_MODEL_NAME])
+        benchmark(transcripts)
@@ -0,0 +1,51 @@
+import os
+import threading
+# make_textでスレッド数の環境変数を設定してからwhisper（torch）を読み込む
+from make_text import WHISPER_MODEL_NAME, ChunkConfig
+import torch
+import whisper
+from loguru import logger
+from batching import MicroBatcher
+from model_registry import registry
+
+# ローカルWhisperによる文字起こし。whisper/torchを読み込むため必要なときだけimportする
+# 同時に届いた複数ファイルのチャンクを1つのモデルでまとめてデコードする
+WHISPER_THREADS = int(os.environ.get("HOMECARE_WHISPER_THREADS", str(os.cpu_count() or 1)))  # torchの演算スレッド数
+WHISPER_BATCH_WAIT_MS = float(os.environ.get("HOMECARE_WHISPER_BATCH_WAIT_MS", "100"))
+
+
+def decode_segments(segments: list) -> list:
+    """30秒以内のチャンクをメルスペクトログラムにしてまとめてデコードする"""
+    model = registry.get(WHISPER_MODEL_NAME)  # 初回のみロードし以降は使い回す
+    options = whisper.DecodingOptions(language="ja", fp16=model.device.type == "cuda")
+    mel = torch.stack([
+        whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(s)), model.dims.n_mels)
+        for s in segments
+    ]).to(model.device)
+    with torch.no_grad():
+        return [r.text for r in whisper.decode(model, mel, options)]
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher() -> MicroBatcher:
+    """デコードを担当するワーカー（1スレッド・1モデル）。待ち件数・バッチサイズは/metricsに出る"""
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                # make_textは環境変数でスレッド数を1に固定しているので、デコードは明示的にコア数分使う
+                torch.set_num_threads(WHISPER_THREADS)
+                logger.info(f"whisper: {WHISPER_THREADS}スレッド, バッチ上限{ChunkConfig().local_batch_size}件")
+                _batcher = MicroBatcher(decode_segments, ChunkConfig().local_batch_size, WHISPER_BATCH_WAIT_MS,
+                                        name="whisper")
+    return _batcher
+
+
+def transcribe_chunks_local(chunks: list) -> list:
+    """チャンクを待ち行列に入れ、他のリクエストのチャンクとまとめてデコードされた結果を順に返す"""
+    batcher = get_batcher()
+    futures = [batcher.submit(chunk) for chunk in chunks]
+    return [future.result() for future in futures]
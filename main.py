@@ -1,29 +1,19 @@
-from make_report import make_report, make_report_local
-from make_text import transcribe_audio, transcribe_audio_local
+from bench import run_benchmark, load_corpus
 from loguru import logger
-import time
+import sys
 
 file_path = "./皮下点滴_田中一郎.m4a"
 
 if __name__ == "__main__":
-    # 音声文字起こし（ローカル）の時間計測
-    start = time.time()
-    #transcript = transcribe_audio_local(file_path)
-    transcript = transcribe_audio(file_path)
-    elapsed = time.time() - start
-    logger.info(f"transcript: {transcript}")
-    logger.info(f"transcribe_audio_local 実行時間: {elapsed:.2f}秒")
-
-    # OpenAIによるレポート生成の時間計測
-    start = time.time()
-    report = make_report(transcript)
-    elapsed = time.time() - start
-    logger.info(f"report: {report}")
-    logger.info(f"make_report 実行時間: {elapsed:.2f}秒")
-
-    # ローカルモデルによるレポート生成の時間計測
-    start = time.time()
-    report_local = make_report_local(transcript)
-    elapsed = time.time() - start
-    logger.info(f"report_local: {report_local}")
-    logger.info(f"make_report_local 実行時間: {elapsed:.2f}秒")
\ No newline at end of file
+    # 1つの録音を1回だけ通して処理時間を確認する（複数回・コーパス全体の計測は bench.py を使う）
+    # python main.py [ネットワークを使う段階 api/fake] [文字起こし api/local/fake] [レポート生成 api,local,fake]
+    # レポート生成はこの録音の文字起こし結果に対して行い、localはモデルのロード後の定常状態の時間を測る
+    backend = sys.argv[1] if len(sys.argv) > 1 else "api"
+    transcribe_backend = sys.argv[2] if len(sys.argv) > 2 else None
+    report_backends = (sys.argv[3] if len(sys.argv) > 3 else "api,local").split(",")
+    corpus = load_corpus(audio_files=[file_path], scales=())
+    result = run_benchmark(1, stages=["decode", "transcribe", "structure", "restyle", "report", "score"],
+                           backend=backend, transcribe_backend=transcribe_backend, corpus=corpus,
+                           report_backends=report_backends, text_from_audio=True)
+    for stage, summary in result["stages"].items():
+        logger.info(f"{stage} 実行時間: {summary['mean_sec']:.2f}秒")
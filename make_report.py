@@ -1,10 +1,40 @@
 import os
-from openai import OpenAI
+import time
+import hashlib
+import openai_client
 from loguru import logger
 from pydantic import BaseModel
 from typing import Optional, List
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextStreamer
-import accelerate
+from model_registry import registry
+
+LOCAL_MODEL_NAME = "weblab-GENIAC/Tanuki-8B-dpo-v1.0"
+# CPU向けの重み量子化（none / int8 / int4）
+LOCAL_QUANTIZATION = os.environ.get("HOMECARE_LOCAL_QUANTIZATION", "none")
+
+
+def load_local_model():
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    if LOCAL_QUANTIZATION == "none":
+        model = AutoModelForCausalLM.from_pretrained(
+            LOCAL_MODEL_NAME, device_map="auto", dtype="auto"
+        )
+    else:
+        import torch
+        from local_report import quantize_model
+        # 量子化前の重みはbfloat16で読み込む（float32だと8Bモデルで約32GBになり、量子化しない場合より大きくなる）
+        model = AutoModelForCausalLM.from_pretrained(
+            LOCAL_MODEL_NAME, device_map="cpu", dtype=torch.bfloat16, low_cpu_mem_usage=True
+        )
+        model = quantize_model(model, LOCAL_QUANTIZATION)
+    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained(LOCAL_MODEL_NAME)
+    # バッチ生成では左側をパディングする
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return model, tokenizer
+
+registry.register(LOCAL_MODEL_NAME, load_local_model)
 
 class HomecareSummary(BaseModel):
     summary: str
@@ -14,50 +44,19 @@ class HomecareSummary(BaseModel):
     plans: List[str]
 
 
-def get_response(transcript: str) -> str:
-    client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-
-    prompt = f"""
-    ## 指示
-    あなたは訪問看護の記録作成支援AIです。以下の"## 会話文字起こし"から、日本語で看護記録の要約を作成してください。
-
-    ## 制約条件
-    - 適宜専門的な用語を使用してください。
+def prior_section(prior: str) -> str:
+    """同じ利用者の過去の記録（RecordStore.prior_context）をプロンプトに入れる節。無ければ空文字"""
+    if not prior:
+        return ""
+    return f"""## 前回までの訪問記録
+    以下は同じ利用者の過去の看護記録です。経過の比較の参考にし、今回の会話に無い内容は記載しないでください。
+    {prior}
 
-    ## 出力形式
-    summary: 要約（3～5行程度、重要点を簡潔に）
-    subjects: 主観情報
-    objects: 客観情報（観察所見・処置内容を箇条書き）
-    assessments: 評価（看護上の解釈・問題点。明確な訴えが無ければ「なし」）
-    plans: 計画（今後の対応や指導、観察継続点）
-
-    ## 会話文字起こし
-    {transcript}
     """
-    response = client.beta.chat.completions.parse(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": transcript}
-        ],
-        response_format=HomecareSummary
-    )
-    return response.choices[0].message.content
 
-def make_report(transcript: str) -> str:
-    # response = get_response(transcript)
-    # report = HomecareSummary.model_validate_json(response)
-    # past_record_path = "./records.txt"
-    new_record_path = "./new_record.txt"
-    
-    #try:
-    #    with open(past_record_path, "r") as f:
-    #         past_record = f.read()
-    # except FileNotFoundError:
-    #     past_record = ""
-        
-    client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-    prompt = f"""
+
+def build_soap_prompt(transcript: str, prior: str = "") -> str:
+    return f"""
     ## 指示
     以下の"## 会話文字起こし"の内容を看護記録としてSOAP形式でまとめてください。
 
@@ -83,10 +82,65 @@ def make_report(transcript: str) -> str:
     ## Summary
     XXX
 
-    ## 会話文字起こし
+    {prior_section(prior)}## 会話文字起こし
     {transcript}
     """
-    response = client.chat.completions.create(
+
+
+REPORT_MODEL = "gpt-4o"
+# プロンプトを変更するとキャッシュ済みのレポートが使われなくなるよう、テンプレートのハッシュを版とする
+REPORT_PROMPT_VERSION = hashlib.sha256(build_soap_prompt("").encode("utf-8")).hexdigest()[:12]
+
+
+def log_stream_timing(name: str, deltas, start: float):
+    """ストリームを中継しつつ最初のトークンまでの時間と合計時間をログに出す（startはリクエスト開始時刻）"""
+    first = None
+    for delta in deltas:
+        if first is None:
+            first = time.perf_counter() - start
+            logger.info(f"{name} 最初のトークンまで: {first:.2f}秒")
+        yield delta
+    total = time.perf_counter() - start
+    logger.info(f"{name} 最初のトークンまで: {first if first is not None else total:.2f}秒 / 合計: {total:.2f}秒")
+
+
+def get_response(transcript: str) -> str:
+    client = openai_client.get_client()
+
+    # 文字起こしはユーザーメッセージで1回だけ送る（システムプロンプトは指示のみ）
+    prompt = """
+    ## 指示
+    あなたは訪問看護の記録作成支援AIです。ユーザーが送る訪問看護の会話文字起こしから、日本語で看護記録の要約を作成してください。
+
+    ## 制約条件
+    - 適宜専門的な用語を使用してください。
+
+    ## 出力形式
+    summary: 要約（3～5行程度、重要点を簡潔に）
+    subjects: 主観情報
+    objects: 客観情報（観察所見・処置内容を箇条書き）
+    assessments: 評価（看護上の解釈・問題点。明確な訴えが無ければ「なし」）
+    plans: 計画（今後の対応や指導、観察継続点）
+    """
+    response = openai_client.call(
+        "get_response",
+        client.beta.chat.completions.parse,
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": transcript}
+        ],
+        response_format=HomecareSummary
+    )
+    return response.choices[0].message.content
+
+def make_report(transcript: str, prior: str = "") -> str:
+    """priorには同じ利用者の過去の記録（RecordStore.prior_context）を渡す"""
+    client = openai_client.get_client()
+    prompt = build_soap_prompt(transcript, prior)
+    response = openai_client.call(
+        "make_report",
+        client.chat.completions.create,
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "あなたは訪問看護の記録作成支援AIです。"},
@@ -97,59 +151,42 @@ def make_report(transcript: str) -> str:
     logger.info(f"new_record: {type(new_record)}")
     return str(new_record)
 
-def make_report_local(transcript: str) -> str:
-    model = AutoModelForCausalLM.from_pretrained(
-        "weblab-GENIAC/Tanuki-8B-dpo-v1.0", device_map="auto", dtype="auto"
+def make_report_stream(transcript: str, prior: str = ""):
+    """make_reportのストリーミング版。生成されたテキストの差分を順にyieldする"""
+    start = time.perf_counter()
+    client = openai_client.get_client()
+    prompt = build_soap_prompt(transcript, prior)
+    stream = openai_client.call(
+        "make_report_stream",
+        client.chat.completions.create,
+        model=REPORT_MODEL,
+        messages=[
+            {"role": "system", "content": "あなたは訪問看護の記録作成支援AIです。"},
+            {"role": "user", "content": prompt}
+        ],
+        stream=True,
+        stream_options={"include_usage": True},
     )
-    tokenizer = AutoTokenizer.from_pretrained("weblab-GENIAC/Tanuki-8B-dpo-v1.0")
-    streamer = TextStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
-    prompt = f"""
-    ## 指示
-    以下の"## 会話文字起こし"の内容を看護記録としてSOAP形式でまとめてください。
-
-    ## 制約条件
-    - 適宜専門的な用語を使用してください。
-    - マークダウン形式で出力してください。
-    - SummaryはSOAP形式で記載した内容を文章にまとめてください。
 
-    ## 出力形式
-    ## S
-    -XXX
-    -XXX
-    ## O
-    -XXX
-    -XXX
-    ## A
-    -XXX
-    -XXX
-    ## P
-    -XXX
-    -XXX
-    ------------------------
-    ## Summary
-    XXX
-
-    ## 会話文字起こし
-    {transcript}
-    """
-    messages = [
-        {"role": "system", "content": "以下は、タスクを説明する指示です。要求を適切に満たす応答を書きなさい。"},
-        {"role": "user", "content": prompt}
-    ]
-
-    input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt").to(model.device)
-    output_ids = model.generate(
-        input_ids,
-        do_sample=True,
-        streamer=streamer,
-        max_new_tokens=512,
-        temperature=0.5,
-    )
-    
-    # 生成されたテキストをデコード
-    generated_text = tokenizer.decode(output_ids[0][len(input_ids[0]):], skip_special_tokens=True)
-    logger.info(f"Generated text: {generated_text}")
-    return generated_text
+    def deltas():
+        # 途中で接続が切れても同時実行数の枠を返すよう、withで閉じる
+        with stream:
+            for chunk in stream:
+                # 最後のチャンクにトークン使用量が入る
+                openai_client.record_usage("make_report_stream", chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    yield from log_stream_timing("make_report_stream", deltas(), start)
+
+def make_report_local(transcript: str, prior: str = "") -> str:
+    # transformersはローカルモデルを使うときだけ読み込む
+    from local_report import make_report_local as _make_report_local
+    return _make_report_local(transcript, prior)
+
+def make_report_local_stream(transcript: str, prior: str = ""):
+    from local_report import make_report_local_stream as _make_report_local_stream
+    return _make_report_local_stream(transcript, prior)
 
 if __name__ == "__main__":
     with open("script.txt", "r") as f:
@@ -1,7 +1,15 @@
 import os
-import whisper
-from openai import OpenAI
+import io
+import wave
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import ffmpeg
+import openai_client
 from loguru import logger
+from pydantic import BaseModel
+from model_registry import registry
+from telemetry import span, payload_bytes, in_context
 
 # OpenBLASの警告を抑制
 os.environ['OPENBLAS_NUM_THREADS'] = '1'
@@ -11,29 +19,220 @@ os.environ['OMP_NUM_THREADS'] = '1'
 # GPU設定（オプション）
 # os.environ['CUDA_VISIBLE_DEVICES'] = '0'  # 特定のGPUを使用する場合
 
-client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-
 file_path = "./レコーディング.m4a"
 
-def transcribe_audio_local(file_path: str) -> str:
+WHISPER_MODEL_NAME = "whisper-turbo"
+TRANSCRIBE_MODEL = "gpt-4o-mini-transcribe"  # もしくは whisper-1
+
+def load_whisper_model():
+    import whisper
     # GPUが利用可能かチェック
     import torch
     device = "cuda" if torch.cuda.is_available() else "cpu"
     logger.info(f"Using device: {device}")
     
-    model = whisper.load_model("turbo", device=device)  # GPU/CPUを自動選択
-    result = model.transcribe(file_path, language="ja")
-    return result["text"]
+    return whisper.load_model("turbo", device=device)  # GPU/CPUを自動選択
 
+registry.register(WHISPER_MODEL_NAME, load_whisper_model)
 
-def transcribe_audio(file_path: str) -> str:
-    with open(file_path, "rb") as f:
-        transcript = client.audio.transcriptions.create(
-            model="gpt-4o-mini-transcribe",  # もしくは whisper-1
-            file=f
-        )
+SAMPLE_RATE = 16000
+# APIへ送る音声の形式（opus / flac / wav）。opusは会話音声なら24kbpsで十分
+API_AUDIO_FORMAT = os.environ.get("HOMECARE_API_AUDIO_FORMAT", "opus")
+OPUS_BITRATE = os.environ.get("HOMECARE_OPUS_BITRATE", "24k")
+# 前後の無音を削る（最大音量のフレームからの相対dBで判定）
+TRIM_SILENCE = os.environ.get("HOMECARE_TRIM_SILENCE", "1") == "1"
+SILENCE_DB = float(os.environ.get("HOMECARE_SILENCE_DB", "-45"))
+
+
+class ChunkConfig(BaseModel):
+    max_chunk_sec: float = float(os.environ.get("HOMECARE_CHUNK_SEC", "300"))  # API用チャンク長の上限
+    local_chunk_sec: float = 28.0  # ローカルWhisperは30秒窓でバッチ処理する
+    overlap_sec: float = float(os.environ.get("HOMECARE_CHUNK_OVERLAP_SEC", "1.0"))
+    concurrency: int = int(os.environ.get("HOMECARE_TRANSCRIBE_CONCURRENCY", "4"))
+    local_batch_size: int = int(os.environ.get("HOMECARE_LOCAL_BATCH_SIZE", "8"))
+    # これより大きいファイルは長い録音とみなす（パイプライン処理の対象）
+    chunked_min_bytes: int = int(os.environ.get("HOMECARE_CHUNKED_MIN_BYTES", str(4 * 1024 * 1024)))
+
+
+def decode_audio(file_path: str) -> np.ndarray:
+    """ffmpegで一度だけデコードし、16kHzモノラルのfloat32配列を返す"""
+    out, _ = (
+        ffmpeg.input(file_path)
+        .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=SAMPLE_RATE)
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return np.frombuffer(out, np.int16).astype(np.float32) / 32768.0
+
+
+def trim_silence(audio: np.ndarray, threshold_db: float = SILENCE_DB, pad_sec: float = 0.3,
+                 frame_sec: float = 0.03) -> np.ndarray:
+    """先頭・末尾の無音フレームを削る（発話の前後はpad_secだけ残す）"""
+    frame = int(SAMPLE_RATE * frame_sec)
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return audio
+    rms = np.sqrt(np.mean(audio[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+    peak = rms.max()
+    if peak <= 0:
+        return audio[:0]
+    voiced = np.nonzero(20 * np.log10(np.maximum(rms, 1e-10) / peak) > threshold_db)[0]
+    pad = int(SAMPLE_RATE * pad_sec)
+    start = max(voiced[0] * frame - pad, 0)
+    end = min((voiced[-1] + 1) * frame + pad, len(audio))
+    return audio[start:end]
+
+
+def load_audio(file_path: str, trim: bool = TRIM_SILENCE) -> np.ndarray:
+    """アップロードされた音声を一度だけ16kHzモノラルにデコードし、前後の無音を削る"""
+    with span("audio_decode"):
+        audio = decode_audio(file_path)
+    duration = len(audio) / SAMPLE_RATE
+    if trim:
+        audio = trim_silence(audio)
+    logger.info(f"音声デコード: {os.path.getsize(file_path)} bytes, {duration:.1f}秒 -> 無音除去後 {len(audio) / SAMPLE_RATE:.1f}秒")
+    return audio
+
+
+def encode_audio(audio: np.ndarray, fmt: str = API_AUDIO_FORMAT) -> tuple:
+    """APIへ送るために圧縮する（(バイト列, 拡張子)を返す）"""
+    with span("audio_encode"):
+        pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+        if fmt == "wav":
+            data, ext = to_wav_bytes(audio), "wav"
+        elif fmt in ("opus", "flac"):
+            options = dict(format="ogg", acodec="libopus", audio_bitrate=OPUS_BITRATE, application="voip") \
+                if fmt == "opus" else dict(format="flac", acodec="flac")
+            data, _ = (
+                ffmpeg.input("pipe:", format="s16le", ac=1, ar=SAMPLE_RATE)
+                .output("pipe:", **options)
+                .run(input=pcm, capture_stdout=True, capture_stderr=True)
+            )
+            ext = "ogg" if fmt == "opus" else "flac"
+        else:
+            raise ValueError(f"不明な音声形式です: {fmt}")
+    payload_bytes.observe(len(data), kind="audio_sent")
+    return data, ext
+
+
+def find_split_points(audio: np.ndarray, max_chunk_sec: float, frame_sec: float = 0.03) -> list:
+    """チャンク長の上限を超えないよう、後半の最も静かなフレームで区切る（エネルギーベースVAD）"""
+    frame = int(SAMPLE_RATE * frame_sec)
+    max_len = int(SAMPLE_RATE * max_chunk_sec)
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return [0, len(audio)]
+    rms = np.sqrt(np.mean(audio[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+
+    points = [0]
+    while len(audio) - points[-1] > max_len:
+        # チャンク後半（上限の50%～100%）の範囲で無音に最も近い位置を探す
+        lo = (points[-1] + max_len // 2) // frame
+        hi = min((points[-1] + max_len) // frame, n_frames)
+        split = (lo + int(np.argmin(rms[lo:hi]))) * frame + frame // 2
+        points.append(split)
+    points.append(len(audio))
+    return points
+
+
+def split_audio(audio: np.ndarray, max_chunk_sec: float, overlap_sec: float) -> list:
+    """区切り位置の前後にoverlap_secずつ重なりを持たせたチャンクに分割する"""
+    points = find_split_points(audio, max_chunk_sec)
+    overlap = int(SAMPLE_RATE * overlap_sec)
+    return [
+        audio[max(start - overlap, 0):min(end + overlap, len(audio))]
+        for start, end in zip(points[:-1], points[1:])
+    ]
+
+
+def to_wav_bytes(audio: np.ndarray) -> bytes:
+    buffered = io.BytesIO()
+    with wave.open(buffered, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes((np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+    return buffered.getvalue()
+
+
+def merge_overlap(prev: str, text: str, max_overlap: int = 50, min_overlap: int = 3) -> str:
+    """前のチャンク末尾と次のチャンク先頭で重複する文字列を取り除いて連結する"""
+    prev = prev.rstrip()
+    text = text.strip()
+    for n in range(min(max_overlap, len(prev), len(text)), min_overlap - 1, -1):
+        if prev.endswith(text[:n]):
+            return prev + text[n:]
+    # 完全一致しない場合は次チャンク先頭付近に前チャンク末尾の一部があるか探す
+    tail = prev[-min_overlap * 2:]
+    if len(tail) >= min_overlap:
+        pos = text.find(tail, 0, max_overlap + len(tail))
+        if pos != -1:
+            return prev + text[pos + len(tail):]
+    return prev + text
+
+
+def stitch_transcripts(texts: list) -> str:
+    result = ""
+    for text in texts:
+        result = merge_overlap(result, text) if result else text.strip()
+    return result
+
+
+def _transcribe_chunk_api(args) -> str:
+    index, chunk = args
+    start = time.perf_counter()
+    client = openai_client.get_client()
+    data, ext = encode_audio(chunk)
+    transcript = openai_client.call(
+        "transcribe",
+        client.audio.transcriptions.create,
+        model=TRANSCRIBE_MODEL,
+        file=(f"chunk_{index:03d}.{ext}", data),
+    )
+    logger.info(f"chunk {index}: {len(chunk) / SAMPLE_RATE:.1f}秒, {len(data)} bytes -> {time.perf_counter() - start:.2f}秒")
     return transcript.text
 
+
+def iter_transcript_chunks(file_path: str, backend: str = "api", config: ChunkConfig = None,
+                           chunk_sec: float = None):
+    """長い音声を無音位置で分割して並列（API）またはバッチ（ローカル）で文字起こしし、先頭から順にyieldする"""
+    config = config or ChunkConfig()
+    start = time.perf_counter()
+    audio = load_audio(file_path)
+    decode_time = time.perf_counter() - start
+
+    chunk_sec = chunk_sec or (config.max_chunk_sec if backend == "api" else config.local_chunk_sec)
+    chunks = split_audio(audio, chunk_sec, config.overlap_sec)
+    logger.info(f"音声長: {len(audio) / SAMPLE_RATE:.1f}秒, デコード: {decode_time:.2f}秒, チャンク数: {len(chunks)}")
+    if len(audio) == 0:
+        return
+
+    if backend == "api":
+        with ThreadPoolExecutor(max_workers=config.concurrency) as executor:
+            # チャンクごとのスパンもジョブのトレースに入るようにする
+            yield from executor.map(in_context(_transcribe_chunk_api), enumerate(chunks))
+    else:
+        from local_whisper import transcribe_chunks_local
+        yield from transcribe_chunks_local(chunks)
+
+
+def transcribe_long_audio(file_path: str, backend: str = "api", config: ChunkConfig = None) -> str:
+    """長い音声を分割して文字起こしし、重複部分を除いて連結する"""
+    start = time.perf_counter()
+    text = stitch_transcripts(list(iter_transcript_chunks(file_path, backend, config)))
+    logger.info(f"分割文字起こし完了: {time.perf_counter() - start:.2f}秒")
+    return text
+
+
+def transcribe_audio_local(file_path: str) -> str:
+    # 短いファイルも30秒以内のチャンクにして、同時に処理中の他のファイルとまとめてデコードする
+    return transcribe_long_audio(file_path, backend="local")
+
+
+def transcribe_audio(file_path: str) -> str:
+    # 元のファイルは送らず、16kHzモノラルにして無音を削り、圧縮したものを送る
+    # （上限より短い録音は1チャンクになり、1回の呼び出しで済む）
+    return transcribe_long_audio(file_path, backend="api")
+
 if __name__ == "__main__":
     file_path = "./皮下点滴_田中一郎.m4a"
     text_local = transcribe_audio_local(file_path)
@@ -0,0 +1,57 @@
+import os
+import sys
+import json
+import subprocess
+from loguru import logger
+
+# Webプロセスの起動時間とメモリを計測する（API専用構成で重いMLライブラリを読み込んでいないかも確認）
+# python measure_startup.py [import秒の上限] [RSS MBの上限]
+HEAVY_MODULES = ["torch", "transformers", "accelerate", "whisper", "sentence_transformers", "faiss"]
+
+PROBE = """
+import json, sys, time, resource
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == "darwin":
+    rss /= 1024  # macOSはバイト単位
+print(json.dumps({
+    "import_sec": elapsed,
+    "max_rss_mb": rss / 1024,
+    "heavy_modules": [m for m in %r if m in sys.modules],
+}))
+"""
+
+
+def measure(env=None) -> dict:
+    """新しいプロセスで `import app` を実行し、import時間・最大RSS・読み込まれた重いモジュールを返す"""
+    env = dict(os.environ, **(env or {}))
+    env.setdefault("OPENAI_API_KEY", "dummy")
+    env.setdefault("HOMECARE_CACHE", "0")
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE % HEAVY_MODULES],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import app に失敗しました:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    max_sec = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    max_rss_mb = float(sys.argv[2]) if len(sys.argv) > 2 else 300.0
+    result = measure()
+    logger.info(f"import app: {result['import_sec']:.2f}秒, 最大RSS {result['max_rss_mb']:.0f}MB")
+    failed = False
+    if result["heavy_modules"]:
+        logger.error(f"重いモジュールが読み込まれています: {', '.join(result['heavy_modules'])}")
+        failed = True
+    if result["import_sec"] > max_sec:
+        logger.error(f"import時間が上限({max_sec}秒)を超えています")
+        failed = True
+    if result["max_rss_mb"] > max_rss_mb:
+        logger.error(f"メモリ使用量が上限({max_rss_mb}MB)を超えています")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,132 @@
+import os
+import sys
+import gc
+import time
+import threading
+from loguru import logger
+
+# モデルのメモリ上限（MB、0で無制限）とアイドル時間（秒、0で無期限）
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("HOMECARE_MODEL_MEMORY_MB", "0"))
+MODEL_IDLE_SEC = float(os.environ.get("HOMECARE_MODEL_IDLE_SEC", "0"))
+
+
+def estimate_size_mb(obj) -> float:
+    """torchモデル（またはそのタプル）のパラメータ・バッファのサイズを概算する"""
+    if isinstance(obj, (tuple, list)):
+        return sum(estimate_size_mb(o) for o in obj)
+    size = 0
+    for attr in ("parameters", "buffers"):
+        if hasattr(obj, attr):
+            size += sum(t.numel() * t.element_size() for t in getattr(obj, attr)())
+    return size / (1024 * 1024)
+
+
+class _Entry:
+    def __init__(self, loader):
+        self.loader = loader
+        self.model = None
+        self.lock = threading.Lock()
+        self.size_mb = 0.0
+        self.load_time = None
+        self.loads = 0
+        self.hits = 0
+        self.last_used = None
+
+
+class ModelRegistry:
+    """モデルをプロセス内で一度だけ遅延ロードして使い回す"""
+
+    def __init__(self, memory_budget_mb: float = MODEL_MEMORY_BUDGET_MB, idle_sec: float = MODEL_IDLE_SEC):
+        self.memory_budget_mb = memory_budget_mb
+        self.idle_sec = idle_sec
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, loader):
+        with self._lock:
+            if name not in self._entries:
+                self._entries[name] = _Entry(loader)
+
+    def get(self, name: str):
+        self.evict_idle()
+        entry = self._entries[name]
+        with entry.lock:
+            if entry.model is None:
+                logger.info(f"モデルをロード中: {name}")
+                start = time.perf_counter()
+                entry.model = entry.loader()
+                entry.load_time = time.perf_counter() - start
+                entry.size_mb = estimate_size_mb(entry.model)
+                entry.loads += 1
+                logger.info(f"モデルロード完了: {name} ({entry.load_time:.2f}秒, {entry.size_mb:.0f}MB)")
+                entry.last_used = time.time()
+                self._enforce_budget(keep=name)
+            else:
+                entry.hits += 1
+            entry.last_used = time.time()
+            return entry.model
+
+    def is_loaded(self, name: str) -> bool:
+        entry = self._entries.get(name)
+        return entry is not None and entry.model is not None
+
+    def warmup(self, names):
+        for name in names:
+            if name in self._entries:
+                self.get(name)
+            else:
+                logger.warning(f"未登録のモデルはウォームアップできません: {name}")
+
+    def evict(self, name: str):
+        entry = self._entries.get(name)
+        if entry is None or entry.model is None:
+            return
+        entry.model = None
+        entry.size_mb = 0.0
+        gc.collect()
+        # torchが読み込まれている場合のみGPUキャッシュを解放
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger.info(f"モデルを解放しました: {name}")
+
+    def evict_idle(self):
+        if not self.idle_sec:
+            return
+        now = time.time()
+        for name, entry in list(self._entries.items()):
+            if entry.model is not None and now - entry.last_used > self.idle_sec:
+                self.evict(name)
+
+    def _enforce_budget(self, keep: str):
+        """メモリ上限を超えたら最後に使われた時刻が古い順に解放する"""
+        if not self.memory_budget_mb:
+            return
+        loaded = sorted(
+            (e.last_used, name) for name, e in self._entries.items()
+            if e.model is not None and name != keep
+        )
+        for _, name in loaded:
+            if self.total_size_mb() <= self.memory_budget_mb:
+                break
+            self.evict(name)
+
+    def total_size_mb(self) -> float:
+        return sum(e.size_mb for e in self._entries.values() if e.model is not None)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "loaded": e.model is not None,
+                "load_time": e.load_time,
+                "loads": e.loads,
+                "hits": e.hits,
+                "size_mb": round(e.size_mb, 1),
+                "last_used": e.last_used,
+            }
+            for name, e in self._entries.items()
+        }
+
+
+# プロセス全体で共有するレジストリ
+registry = ModelRegistry()
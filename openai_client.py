@@ -0,0 +1,192 @@
+import os
+import time
+import random
+import threading
+from contextvars import copy_context
+from openai import OpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from loguru import logger
+from telemetry import span, llm_seconds, llm_tokens, llm_retries
+
+# OpenAI呼び出しの共通設定（環境変数で上書き可能）
+OPENAI_TIMEOUT_SEC = float(os.environ.get("HOMECARE_OPENAI_TIMEOUT_SEC", "120"))
+OPENAI_MAX_RETRIES = int(os.environ.get("HOMECARE_OPENAI_MAX_RETRIES", "5"))
+OPENAI_BACKOFF_BASE_SEC = float(os.environ.get("HOMECARE_OPENAI_BACKOFF_BASE_SEC", "1.0"))
+OPENAI_BACKOFF_MAX_SEC = float(os.environ.get("HOMECARE_OPENAI_BACKOFF_MAX_SEC", "30"))
+OPENAI_CONCURRENCY = int(os.environ.get("HOMECARE_OPENAI_CONCURRENCY", "8"))
+
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+_client = None
+_client_lock = threading.Lock()
+_semaphore = threading.BoundedSemaphore(OPENAI_CONCURRENCY)
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_client() -> OpenAI:
+    """プロセスで共有するOpenAIクライアント（HTTPコネクションを使い回す）
+
+    OPENAI_BASE_URL を設定するとローカルのモックサーバーに向けられる。
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # リトライはcall()側で行うためSDKの自動リトライは無効にする
+                _client = OpenAI(
+                    api_key=os.environ["OPENAI_API_KEY"],
+                    timeout=OPENAI_TIMEOUT_SEC,
+                    max_retries=0,
+                )
+    return _client
+
+
+def _stat(name: str) -> dict:
+    return _stats.setdefault(name, {
+        "calls": 0, "errors": 0, "retries": 0, "latency_sec": 0.0,
+        "prompt_tokens": 0, "completion_tokens": 0,
+    })
+
+
+def record_usage(name: str, usage):
+    """レスポンスのusageからトークン数を集計する"""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or getattr(usage, "input_tokens", None) or 0
+    completion_tokens = getattr(usage, "completion_tokens", None) or getattr(usage, "output_tokens", None) or 0
+    with _stats_lock:
+        stat = _stat(name)
+        stat["prompt_tokens"] += prompt_tokens
+        stat["completion_tokens"] += completion_tokens
+    llm_tokens.observe(prompt_tokens, call=name, direction="prompt")
+    llm_tokens.observe(completion_tokens, call=name, direction="completion")
+
+
+def backoff_delay(attempt: int, error=None) -> float:
+    """Retry-Afterがあればそれに従い、無ければジッター付き指数バックオフ"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), OPENAI_BACKOFF_MAX_SEC)
+        except ValueError:
+            pass
+    delay = min(OPENAI_BACKOFF_BASE_SEC * (2 ** attempt), OPENAI_BACKOFF_MAX_SEC)
+    return random.uniform(0, delay)
+
+
+class HeldStream:
+    """stream=Trueの応答。読み終えるか閉じるまで同時実行数の枠とスパンを保持する
+
+    途中でやめる場合はclose()するか、withブロックで使う。
+    """
+
+    def __init__(self, name: str, stream, context, span_cm, start: float):
+        self.name = name
+        self._stream = stream
+        self._context = context
+        self._span = span_cm
+        self._start = start
+        self._done = False
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        except Exception as e:
+            self._finish(e)
+            raise
+        finally:
+            self._finish()
+
+    def _finish(self, error: Exception = None):
+        if self._done:
+            return
+        self._done = True
+        try:
+            # スパンは開いたときと同じContextで閉じる（呼び出し元のContextの親スパンを変えないため）
+            self._context.run(self._span.__exit__, type(error) if error else None, error,
+                              error.__traceback__ if error else None)
+        finally:
+            _semaphore.release()
+        with _stats_lock:
+            stat = _stat(self.name)
+            if error is None:
+                stat["calls"] += 1
+                stat["latency_sec"] += time.perf_counter() - self._start
+            else:
+                stat["errors"] += 1
+
+    def close(self):
+        try:
+            if hasattr(self._stream, "close"):
+                self._stream.close()
+        finally:
+            self._finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _open_stream(name: str, attempt: int, start: float, fn, *args, **kwargs) -> HeldStream:
+    context = copy_context()
+    span_cm = span(name, llm_seconds, attempt=attempt, stream=True)
+    _semaphore.acquire()
+    try:
+        context.run(span_cm.__enter__)
+        try:
+            stream = fn(*args, **kwargs)
+        except BaseException as e:
+            context.run(span_cm.__exit__, type(e), e, e.__traceback__)
+            raise
+    except BaseException:
+        _semaphore.release()
+        raise
+    return HeldStream(name, stream, context, span_cm, start)
+
+
+def call(name: str, fn, *args, **kwargs):
+    """同時実行数を制限し、レート制限・タイムアウト時はバックオフして再試行する
+
+    stream=Trueのときは、返したストリームを読み終えるか閉じるまで同時実行数の枠とスパンを保持する。
+    """
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            if kwargs.get("stream"):
+                return _open_stream(name, attempt, start, fn, *args, **kwargs)
+            with _semaphore, span(name, llm_seconds, attempt=attempt):
+                response = fn(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            with _stats_lock:
+                stat = _stat(name)
+                stat["errors"] += 1
+                if attempt < OPENAI_MAX_RETRIES:
+                    stat["retries"] += 1
+            if attempt >= OPENAI_MAX_RETRIES:
+                raise
+            llm_retries.inc(call=name)
+            delay = backoff_delay(attempt, e)
+            logger.warning(f"{name} 再試行 {attempt + 1}/{OPENAI_MAX_RETRIES} ({type(e).__name__}) {delay:.2f}秒後")
+            time.sleep(delay)
+            attempt += 1
+            continue
+        except Exception:
+            with _stats_lock:
+                _stat(name)["errors"] += 1
+            raise
+        elapsed = time.perf_counter() - start
+        with _stats_lock:
+            stat = _stat(name)
+            stat["calls"] += 1
+            stat["latency_sec"] += elapsed
+        record_usage(name, getattr(response, "usage", None))
+        return response
+
+
+def stats() -> dict:
+    with _stats_lock:
+        return {name: dict(stat) for name, stat in _stats.items()}
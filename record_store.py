@@ -0,0 +1,313 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from typing import Optional
+from pydantic import BaseModel
+from loguru import logger
+from soap import split_soap_sections, split_dated_records
+
+# 利用者ごとの訪問記録（文字起こし・SOAP）を保存し、全文検索と直近の記録の取得を行う
+RECORD_DB_PATH = os.environ.get("HOMECARE_RECORD_DB", "records.db")
+# 直近の記録をプロンプトに含めるときの件数
+PRIOR_VISITS = int(os.environ.get("HOMECARE_PRIOR_VISITS", "3"))
+SECTION_COLUMNS = {"S": "subjects", "O": "objects", "A": "assessments", "P": "plans", "Summary": "summary"}
+TEXT_COLUMNS = ["transcript", "summary", "subjects", "objects", "assessments", "plans"]
+
+
+class VisitRecord(BaseModel):
+    patient_id: str
+    visited_at: float
+    transcript: str = ""
+    summary: str = ""
+    subjects: str = ""
+    objects: str = ""
+    assessments: str = ""
+    plans: str = ""
+    report: str = ""
+    sha256: Optional[str] = None  # 元の録音のハッシュ（同じ録音の再アップロードで記録が重複しないように）
+    id: Optional[int] = None
+
+    @classmethod
+    def from_summary(cls, patient_id: str, summary, transcript: str = "", report: str = "",
+                     visited_at: float = None) -> "VisitRecord":
+        """HomecareSummaryから作る（リストの項目は1行ずつにする）"""
+        def lines(items):
+            return "\n".join(i.strip() for i in (items or []) if i and i.strip())
+        return cls(patient_id=patient_id, visited_at=visited_at or time.time(), transcript=transcript,
+                   summary=summary.summary.strip(), subjects=lines(summary.subjects), objects=lines(summary.objects),
+                   assessments=lines(summary.assessments), plans=lines(summary.plans), report=report)
+
+    @classmethod
+    def from_report(cls, patient_id: str, report: str, transcript: str = "",
+                    visited_at: float = None, sha256: str = None) -> "VisitRecord":
+        """SOAP形式のマークダウン（## S など）から作る"""
+        sections = split_soap_sections(report)
+        fields = {column: sections.get(name, "") for name, column in SECTION_COLUMNS.items()}
+        if not any(fields.values()):
+            # 見出しの形式が違う記録も検索できるよう全文を要約として持つ
+            fields["summary"] = report.strip()
+        return cls(patient_id=patient_id, visited_at=visited_at or time.time(), transcript=transcript,
+                   report=report, sha256=sha256, **fields)
+
+    def render(self) -> str:
+        """プロンプトに含める形式（日付とSOAPの各項目）"""
+        date = time.strftime("%Y/%m/%d", time.localtime(self.visited_at))
+        parts = [date]
+        for name, column in SECTION_COLUMNS.items():
+            value = getattr(self, column)
+            if value:
+                parts.append(f"{name}\n{value}")
+        return "\n".join(parts)
+
+
+_COLUMNS = ["patient_id", "visited_at", "transcript", "summary", "subjects", "objects", "assessments", "plans",
+            "report", "sha256"]
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS visits (
+    id INTEGER PRIMARY KEY,
+    patient_id TEXT NOT NULL, visited_at REAL NOT NULL,
+    transcript TEXT, summary TEXT, subjects TEXT, objects TEXT, assessments TEXT, plans TEXT, report TEXT,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS visits_patient_time ON visits (patient_id, visited_at DESC);
+-- 日本語は単語で区切れないのでtrigramで索引を作る（本文はvisitsにだけ持つ）
+CREATE VIRTUAL TABLE IF NOT EXISTS visits_fts USING fts5(
+    {", ".join(TEXT_COLUMNS)}, content='visits', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS visits_ai AFTER INSERT ON visits BEGIN
+    INSERT INTO visits_fts (rowid, {", ".join(TEXT_COLUMNS)})
+    VALUES (new.id, {", ".join("new." + c for c in TEXT_COLUMNS)});
+END;
+CREATE TRIGGER IF NOT EXISTS visits_ad AFTER DELETE ON visits BEGIN
+    INSERT INTO visits_fts (visits_fts, rowid, {", ".join(TEXT_COLUMNS)})
+    VALUES ('delete', old.id, {", ".join("old." + c for c in TEXT_COLUMNS)});
+END;
+"""
+# 同じ利用者の同じ録音は1件だけにする（sha256がNULLの取り込み記録は対象外）
+_UNIQUE_RECORDING = "CREATE UNIQUE INDEX IF NOT EXISTS visits_patient_sha256 ON visits (patient_id, sha256)"
+
+
+class RecordStore:
+    """訪問記録のSQLiteストア（FTS5のtrigram索引付き）"""
+
+    def __init__(self, db_path: str = RECORD_DB_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(visits)")]
+        if "sha256" not in columns:
+            # 録音のハッシュを持つ前に作ったDB
+            self._conn.execute("ALTER TABLE visits ADD COLUMN sha256 TEXT")
+        self._conn.execute(_UNIQUE_RECORDING)
+        self._conn.commit()
+
+    def add_many(self, records) -> list:
+        """まとめて1トランザクションで追加し、idのリストを返す
+
+        アプリと取り込み処理が同じDBに同時に書き込むため、idは行ごとにlastrowidで受け取る。
+        同じ利用者・同じ録音（sha256）の記録が既にあれば追加せず、既存の記録のidを返す。
+        """
+        sql = (f"INSERT INTO visits ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))}) "
+               f"ON CONFLICT (patient_id, sha256) DO NOTHING")
+        ids = []
+        with self._lock, self._conn:
+            for r in records:
+                cursor = self._conn.execute(sql, tuple(getattr(r, c) for c in _COLUMNS))
+                if cursor.rowcount:
+                    ids.append(cursor.lastrowid)
+                    continue
+                logger.info(f"{r.patient_id}: 同じ録音の記録があるため追加しません")
+                ids.append(self._conn.execute("SELECT id FROM visits WHERE patient_id = ? AND sha256 = ?",
+                                              (r.patient_id, r.sha256)).fetchone()[0])
+        return ids
+
+    def add(self, record: VisitRecord) -> int:
+        return self.add_many([record])[0]
+
+    def recent_visits(self, patient_id: str, n: int = PRIOR_VISITS, exclude_sha256: str = None) -> list:
+        """利用者の直近n件の記録を新しい順に返す（(patient_id, visited_at)の索引だけで引く）
+
+        exclude_sha256を渡すとその録音の記録を除く（処理中の録音を再アップロードした場合）。
+        """
+        where, params = "patient_id = ?", [patient_id]
+        if exclude_sha256 is not None:
+            where += " AND sha256 IS NOT ?"
+            params.append(exclude_sha256)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM visits WHERE {where} ORDER BY visited_at DESC LIMIT ?", (*params, n)
+            ).fetchall()
+        return [VisitRecord(**dict(row)) for row in rows]
+
+    def prior_context(self, patient_id: str, n: int = PRIOR_VISITS, exclude_sha256: str = None) -> str:
+        """直近の記録をプロンプト用のテキストにする（古い順）"""
+        return "\n\n".join(r.render() for r in reversed(self.recent_visits(patient_id, n, exclude_sha256)))
+
+    def search(self, query: str, patient_id: str = None, limit: int = 20, by_rank: bool = False) -> list:
+        """本文・SOAPの各項目を全文検索する（空白区切りの語をすべて含む記録）
+
+        既定では新しい順（利用者指定時は訪問日時、全体では登録順）に返し、上位limit件で走査を打ち切る。
+        by_rank=Trueなら関連度順（一致した記録をすべて採点するので語が多くの記録に出ると遅い）。
+        trigramは3文字未満の語を索引で引けないため、短い語はLIKEで絞り込む。
+        """
+        terms = query.split()
+        long_terms = [t for t in terms if len(t) >= 3]
+        short_terms = [t for t in terms if len(t) < 3]
+        if not terms:
+            return []
+        where, params = [], []
+        if long_terms:
+            where.append("visits_fts MATCH ?")
+            params.append(" ".join('"' + t.replace('"', '""') + '"' for t in long_terms))
+        for term in short_terms:
+            where.append("(" + " OR ".join(f"visits.{c} LIKE ?" for c in TEXT_COLUMNS) + ")")
+            params.extend([f"%{term}%"] * len(TEXT_COLUMNS))
+        if patient_id is not None:
+            # 利用者の記録は少ないので、索引で利用者の記録を引いてから全文検索の条件を当てる
+            where.append("visits.patient_id = ?")
+            params.append(patient_id)
+            tables = "visits CROSS JOIN visits_fts ON visits_fts.rowid = visits.id" if long_terms else "visits"
+            order = "visits.visited_at DESC"
+        else:
+            tables = "visits_fts JOIN visits ON visits.id = visits_fts.rowid" if long_terms else "visits"
+            # 全文検索の索引はrowid順に並んでいるので、降順ならlimit件で打ち切れる
+            order = "visits_fts.rowid DESC" if long_terms else "visits.id DESC"
+        if by_rank and long_terms:
+            order = "visits_fts.rank"
+        sql = f"SELECT visits.* FROM {tables} WHERE {' AND '.join(where)} ORDER BY {order} LIMIT ?"
+        with self._lock:
+            rows = self._conn.execute(sql, params + [limit]).fetchall()
+        return [VisitRecord(**dict(row)) for row in rows]
+
+    def stats(self) -> dict:
+        with self._lock:
+            visits, patients = self._conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT patient_id) FROM visits").fetchone()
+        return {"visits": visits, "patients": patients}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> RecordStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = RecordStore()
+    return _store
+
+
+def read_flat_files(patient_id: str, records_path: str = "records.txt",
+                    new_record_path: str = "new_record.txt") -> list:
+    """records.txt（日付行で区切った記録）とnew_record.txtを1人分の記録として読み込む"""
+    records = []
+    if os.path.exists(records_path):
+        with open(records_path, "r") as f:
+            for text in split_dated_records(f.read()):
+                date, _, body = text.partition("\n")
+                records.append(VisitRecord(patient_id=patient_id, visited_at=_parse_date(date),
+                                           report=text, **_split_plain_soap(body)))
+    if os.path.exists(new_record_path):
+        with open(new_record_path, "r") as f:
+            text = f.read()
+        date = re.search(r"日付[:：]\s*(\d{1,2}/\d{1,2})", text)
+        records.append(VisitRecord.from_report(patient_id, text, visited_at=_parse_date(date.group(1)) if date else None))
+    return records
+
+
+def import_flat_files(store: RecordStore, patient_id: str, records_path: str = "records.txt",
+                      new_record_path: str = "new_record.txt") -> int:
+    records = read_flat_files(patient_id, records_path, new_record_path)
+    store.add_many(records)
+    logger.info(f"{patient_id}: {len(records)}件の記録を取り込みました")
+    return len(records)
+
+
+def _parse_date(text: str) -> float:
+    """'8/17' のような日付（年なし）を今年の日付として解釈する"""
+    month, day = (int(v) for v in text.strip().split("/"))
+    return time.mktime((time.localtime().tm_year, month, day, 0, 0, 0, 0, 0, -1))
+
+
+def _split_plain_soap(body: str) -> dict:
+    """records.txtの 'S ...' 'O' のような見出しで項目に分ける"""
+    fields, current = {}, None
+    for line in body.splitlines():
+        head = line.strip()[:1]
+        if head in ("S", "O", "A", "P") and line.strip()[1:2] in ("", " ", "　"):
+            current = SECTION_COLUMNS[head]
+            line = line.strip()[1:]
+        if current is not None and line.strip():
+            fields[current] = (fields.get(current, "") + "\n" + line.strip().lstrip("・")).strip()
+    return fields
+
+
+def benchmark(n: int = 100000, patients: int = 1000, batch_size: int = 1000, queries: int = 200,
+              db_path: str = "records_bench.db") -> dict:
+    """n件の合成記録を一括挿入し、直近n件の取得と全文検索のレイテンシを計測する"""
+    import random
+    import numpy as np
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    store = RecordStore(db_path)
+    # 既存の記録を利用者・日時を変えて複製する
+    templates = read_flat_files("template")
+    random.seed(0)
+    base = time.time() - n * 3600
+
+    def synthetic(i):
+        return random.choice(templates).model_copy(
+            update={"patient_id": f"patient-{i % patients:05d}", "visited_at": base + i * 3600})
+
+    start = time.perf_counter()
+    for i in range(0, n, batch_size):
+        store.add_many([synthetic(j) for j in range(i, min(n, i + batch_size))])
+    insert_sec = time.perf_counter() - start
+
+    def measure(fn, args):
+        latencies = []
+        for a in args:
+            t = time.perf_counter()
+            fn(a)
+            latencies.append((time.perf_counter() - t) * 1000)
+        return {"p50_ms": round(float(np.percentile(latencies, 50)), 3),
+                "p95_ms": round(float(np.percentile(latencies, 95)), 3)}
+
+    patient_ids = [f"patient-{random.randrange(patients):05d}" for _ in range(queries)]
+    words = ["抗生剤", "SpO₂", "とろみ", "ルームエアー", "痰"]
+    result = {
+        "records": n,
+        "insert_sec": round(insert_sec, 2),
+        "inserts_per_sec": round(n / insert_sec),
+        "recent_visits": measure(lambda p: store.recent_visits(p, PRIOR_VISITS), patient_ids),
+        "search": measure(lambda w: store.search(w, limit=20), [random.choice(words[:4]) for _ in range(queries)]),
+        "search_by_rank": measure(lambda w: store.search(w, limit=20, by_rank=True),
+                                  [random.choice(words[:4]) for _ in range(max(1, queries // 10))]),
+        "search_patient": measure(lambda p: store.search("抗生剤", patient_id=p), patient_ids),
+        "search_short_term": measure(lambda w: store.search(w, limit=20), ["痰"] * max(1, queries // 10)),
+        "db_mb": round(os.path.getsize(db_path) / (1024 * 1024), 1),
+    }
+    logger.success(f"記録ストアのベンチマーク: {result}")
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+    # python record_store.py import 利用者ID : records.txt・new_record.txt を取り込む
+    # python record_store.py bench [件数]
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "import":
+        import_flat_files(get_store(), sys.argv[2])
+    elif command == "bench":
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+    else:
+        sys.exit("使い方: python record_store.py import 利用者ID | bench [件数]")
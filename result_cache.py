@@ -0,0 +1,96 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from loguru import logger
+
+# 文字起こし・レポートの永続キャッシュ設定
+CACHE_DB_PATH = os.environ.get("HOMECARE_CACHE_DB", "cache.db")
+CACHE_TTL_SEC = int(os.environ.get("HOMECARE_CACHE_TTL_SEC", str(30 * 24 * 3600)))
+CACHE_MAX_MB = float(os.environ.get("HOMECARE_CACHE_MAX_MB", "500"))
+
+
+def text_sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def transcript_key(audio_sha256: str, model: str) -> str:
+    return f"{audio_sha256}:{model}"
+
+
+def report_key(transcript: str, model: str, prompt_version: str, prior: str = "") -> str:
+    # 過去の記録をプロンプトに入れた場合は、その内容もキーに含める
+    key = f"{text_sha256(transcript)}:{model}:{prompt_version}"
+    return f"{key}:{text_sha256(prior)[:16]}" if prior else key
+
+
+class ResultCache:
+    """音声・文字起こしのハッシュをキーにした結果キャッシュ（SQLite）"""
+
+    def __init__(self, db_path: str = CACHE_DB_PATH, ttl_sec: int = CACHE_TTL_SEC, max_mb: float = CACHE_MAX_MB):
+        self.ttl_sec = ttl_sec
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "kind TEXT, key TEXT, value TEXT, size INTEGER, created_at REAL, last_access REAL, "
+            "PRIMARY KEY (kind, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        self._conn.commit()
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, kind: str, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM cache WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+            if row is not None and now - row[1] > self.ttl_sec:
+                self._conn.execute("DELETE FROM cache WHERE kind = ? AND key = ?", (kind, key))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+                logger.info(f"cache miss: {kind}")
+                return None
+            self._conn.execute(
+                "UPDATE cache SET last_access = ? WHERE kind = ? AND key = ?", (now, kind, key)
+            )
+            self._conn.commit()
+            self.hits[kind] = self.hits.get(kind, 0) + 1
+            logger.info(f"cache hit: {kind}")
+            return row[0]
+
+    def set(self, kind: str, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (kind, key, value, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, key, value, len(value.encode("utf-8")), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float):
+        """期限切れを削除し、容量上限を超えていれば最終アクセスが古い順に削除する"""
+        self._conn.execute("DELETE FROM cache WHERE created_at < ?", (now - self.ttl_sec,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT kind, key, size FROM cache ORDER BY last_access").fetchall()
+        for kind, key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM cache WHERE kind = ? AND key = ?", (kind, key))
+            total -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        return {"hits": dict(self.hits), "misses": dict(self.misses), "entries": entries, "bytes": size}
@@ -0,0 +1,45 @@
+import re
+
+# SOAP形式の看護記録テキストを扱うヘルパ
+SECTION_NAMES = ["S", "O", "A", "P", "Summary"]
+_HEADING_RE = re.compile(r"^\s*##\s*(S|O|A|P|Summary)\s*$", re.MULTILINE)
+
+
+def split_soap_sections(text: str) -> dict:
+    """'## S' などの見出しでレポートを分割する（生成途中のテキストにも使える）"""
+    sections = {}
+    matches = list(_HEADING_RE.finditer(text))
+    for i, m in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        body = text[m.end():end]
+        # 区切り線はSummaryの前置きなので除く
+        body = re.sub(r"^\s*-{4,}\s*$", "", body, flags=re.MULTILINE)
+        sections[m.group(1)] = body.strip()
+    return sections
+
+
+def split_dated_records(text: str) -> list:
+    """records.txtのように日付行（8/17など）で始まる記録を1件ずつに分割する"""
+    parts = re.split(r"\n\s*\n+(?=\d{1,2}/\d{1,2}\s*\n)", text.strip())
+    return [p.strip() for p in parts if p.strip()]
+
+
+def _bullets(items) -> str:
+    items = [i for i in (items or []) if i and i.strip()]
+    return "\n".join(f"- {i.strip()}" for i in items) if items else "- なし"
+
+
+def render_soap_markdown(summary) -> str:
+    """HomecareSummaryをSOAP形式のマークダウンに整形する（LLMを使わずローカルで行う）"""
+    return f"""## S
+{_bullets(summary.subjects)}
+## O
+{_bullets(summary.objects)}
+## A
+{_bullets(summary.assessments)}
+## P
+{_bullets(summary.plans)}
+------------------------
+## Summary
+{summary.summary.strip()}
+"""
@@ -0,0 +1,226 @@
+import os
+import time
+import uuid
+import random
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from loguru import logger
+
+# 処理段階のスパンとPrometheus形式のメトリクス（/metrics）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 5e7, 1e8, 5e8)
+TOKEN_BUCKETS = (100, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32)
+# 文字起こし・レポート本文のログ：INFOでは先頭だけ出し、全文はDEBUGでサンプリングした分だけ出す
+LOG_PREVIEW_CHARS = int(os.environ.get("HOMECARE_LOG_PREVIEW_CHARS", "200"))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("HOMECARE_LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra: str = "") -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(k, "")) for k in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        key = tuple(str(labels.get(k, "")) for k in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self) -> list:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # ラベル -> [バケットごとの件数, 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(k, "")) for k in self.labelnames)
+        with self._lock:
+            counts, _, _ = entry = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, n in zip(self.buckets, counts):
+                    le = 'le="%g"' % bound
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {n}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+stage_seconds = Histogram("homecare_stage_seconds", "処理段階（スパン）の所要時間", ["stage", "outcome"])
+payload_bytes = Histogram("homecare_payload_bytes", "アップロード・文字起こし・レポートのサイズ", ["kind"], BYTES_BUCKETS)
+llm_seconds = Histogram("homecare_llm_call_seconds", "OpenAI API呼び出しの所要時間", ["call", "outcome"])
+llm_tokens = Histogram("homecare_llm_tokens", "1回のAPI呼び出しのトークン数", ["call", "direction"], TOKEN_BUCKETS)
+llm_retries = Counter("homecare_llm_retries_total", "OpenAI API呼び出しの再試行回数", ["call"])
+batch_size = Histogram("homecare_batch_size", "まとめて処理した件数", ["batcher"], BATCH_BUCKETS)
+batch_wait_seconds = Histogram("homecare_batch_wait_seconds", "バッチ処理が始まるまでの待ち時間", ["batcher"])
+queue_depth = Gauge("homecare_batch_queue_depth", "バッチ処理の待ち件数", ["batcher"])
+METRICS = [stage_seconds, payload_bytes, llm_seconds, llm_tokens, llm_retries,
+           batch_size, batch_wait_seconds, queue_depth]
+
+# 現在のトレース（ジョブ）とスパンの親子関係
+_trace_id = ContextVar("homecare_trace_id", default=None)
+_span_id = ContextVar("homecare_span_id", default=None)
+
+
+@contextmanager
+def trace(trace_id: str = None):
+    """このブロック内のスパンに共通のトレースID（ジョブIDなど）を付ける"""
+    token = _trace_id.set(trace_id or uuid.uuid4().hex)
+    try:
+        yield _trace_id.get()
+    finally:
+        _trace_id.reset(token)
+
+
+@contextmanager
+def span(name: str, histogram: Histogram = stage_seconds, **attrs):
+    """所要時間をヒストグラムに記録し、トレースID・親スパン付きの構造化ログを出す"""
+    span_id = uuid.uuid4().hex[:16]
+    parent_id = _span_id.get()
+    token = _span_id.set(span_id)
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield attrs
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        _span_id.reset(token)
+        elapsed = time.perf_counter() - start
+        labels = {"call": name} if histogram is llm_seconds else {"stage": name}
+        histogram.observe(elapsed, outcome=outcome, **labels)
+        logger.bind(trace_id=_trace_id.get(), span_id=span_id, parent_id=parent_id,
+                    span=name, duration_sec=round(elapsed, 4), outcome=outcome, **attrs).info(
+            f"span {name}: {elapsed:.3f}秒 ({outcome})")
+
+
+def in_context(fn):
+    """fnを呼び出し元のトレース・親スパンを引き継いで実行する関数を返す（スレッドプールやThreadに渡す用）
+
+    同じContextは複数のスレッドで同時に使えないため、呼び出しごとに複製して実行する。
+    """
+    context = copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+def current_rss_mb():
+    """現在の常駐メモリ（MB）。/procの無い環境ではNone
+
+    ru_maxrssはプロセス開始からの最大値で減らないため、処理ごとの比較には使えない。
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+class RssSampler:
+    """withブロックの実行中に現在のRSSを一定間隔で測り、開始時からの最大の増加量（delta_mb）を求める"""
+
+    def __init__(self, interval_sec: float = 0.05):
+        self.interval_sec = interval_sec
+        self.start_mb = None
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss_mb()
+        if rss is not None:
+            self.peak_mb = max(self.peak_mb, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_sec):
+            self._sample()
+
+    def __enter__(self):
+        self.start_mb = self.peak_mb = current_rss_mb()
+        if self.start_mb is not None:
+            self._thread = threading.Thread(target=self._run, name="homecare-rss", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+
+    @property
+    def delta_mb(self):
+        return None if self.start_mb is None else self.peak_mb - self.start_mb
+
+
+def preview(text: str, limit: int = LOG_PREVIEW_CHARS) -> str:
+    if text is None or len(text) <= limit:
+        return text
+    return f"{text[:limit]}…（全{len(text)}文字）"
+
+
+def log_payload(name: str, text: str):
+    """本文のサイズを記録し、ログには先頭だけ出す（全文はDEBUGかつサンプリングされた場合のみ）"""
+    payload_bytes.observe(len(text.encode("utf-8")), kind=name)
+    logger.info(f"{name}: {preview(text)}")
+    if LOG_PAYLOAD_SAMPLE_RATE and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        logger.debug(f"{name}（全文）: {text}")
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,28 @@
+from functools import lru_cache
+from loguru import logger
+
+# gpt-4o系のトークナイザ。tiktokenが無い環境では文字数で近似する（日本語では概ね上限側の見積もり）
+ENCODING_NAME = "o200k_base"
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning("tiktokenがインストールされていないため、トークン数の代わりに文字数を使います"
+                       "（pip install tiktoken）")
+        return None
+    return tiktoken.get_encoding(ENCODING_NAME)
+
+
+def token_unit() -> str:
+    """count_tokensが数えている単位（tiktokenが無ければ"chars"）。計測結果に添えて記録する"""
+    return ENCODING_NAME if _encoding() is not None else "chars"
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text))
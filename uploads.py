@@ -0,0 +1,82 @@
+import os
+import hashlib
+import tempfile
+from pydantic import BaseModel
+from loguru import logger
+
+CHUNK_SIZE = 1024 * 1024  # 1MBずつ書き込む
+
+
+class UploadError(Exception):
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class SavedUpload(BaseModel):
+    path: str
+    filename: str
+    format: str
+    size: int
+    sha256: str
+
+
+def detect_format(head: bytes):
+    """先頭バイト（マジックナンバー）からファイル形式を判定する"""
+    if head[4:8] == b"ftyp":
+        # MP4コンテナ: ブランドがM4Aなら音声
+        return "m4a" if head[8:12] in (b"M4A ", b"M4B ") else "mp4"
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[:3] == b"ID3" or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0 and head[1] & 0x06):
+        # ID3タグ付き、またはMPEGオーディオのフレーム同期
+        return "mp3"
+    if head[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    return None
+
+
+def file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def save_upload(stream, filename: str, upload_dir: str, allowed_formats, max_bytes: int) -> SavedUpload:
+    """アップロードを一定サイズずつ一時ファイルへ書き出しながらSHA-256を計算する"""
+    fd, tmp_path = tempfile.mkstemp(dir=upload_dir, prefix="upload_", suffix=".part")
+    sha256 = hashlib.sha256()
+    size = 0
+    file_format = None
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if file_format is None:
+                    file_format = detect_format(chunk[:16])
+                    if file_format not in allowed_formats:
+                        raise UploadError("許可されていないファイル形式です")
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadError(f"ファイルサイズが上限({max_bytes // (1024 * 1024)}MB)を超えています", 413)
+                sha256.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise UploadError("ファイルが空です")
+        path = tmp_path[:-len(".part")] + f".{file_format}"
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    logger.info(f"アップロード保存完了: {path} ({size} bytes, {file_format}, sha256={sha256.hexdigest()[:12]})")
+    return SavedUpload(path=path, filename=filename, format=file_format, size=size, sha256=sha256.hexdigest())
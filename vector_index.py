@@ -0,0 +1,251 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+import faiss
+from loguru import logger
+
+# 文書の埋め込みをSQLiteに保存し、FAISSインデックスをファイルに永続化する
+INDEX_TYPE = os.environ.get("HOMECARE_INDEX_TYPE", "flat")  # flat / ivf / hnsw
+IVF_NLIST = int(os.environ.get("HOMECARE_IVF_NLIST", "256"))
+IVF_NPROBE = int(os.environ.get("HOMECARE_IVF_NPROBE", "16"))
+HNSW_M = int(os.environ.get("HOMECARE_HNSW_M", "32"))
+HNSW_EF_SEARCH = int(os.environ.get("HOMECARE_HNSW_EF_SEARCH", "64"))
+# FAISSはIVFの学習にセントロイドあたり約39件を求める（少ないと警告が出てクラスタの質も落ちる）
+IVF_POINTS_PER_CENTROID = 39
+EMBED_BATCH_SIZE = 256
+
+
+def build_index(dimension: int, index_type: str = "flat", embeddings: np.ndarray = None,
+                nlist: int = IVF_NLIST, nprobe: int = IVF_NPROBE, hnsw_m: int = HNSW_M,
+                ef_search: int = HNSW_EF_SEARCH):
+    """IDを持てるFAISSインデックスを作る（IVFはembeddingsで学習する）"""
+    if index_type == "ivf":
+        n = 0 if embeddings is None else len(embeddings)
+        if n >= nlist * IVF_POINTS_PER_CENTROID:
+            quantizer = faiss.IndexFlatL2(dimension)
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+            index.train(embeddings)
+            index.nprobe = nprobe
+            return index
+        logger.warning(f"IVFの学習には{nlist * IVF_POINTS_PER_CENTROID}件以上必要です（{n}件）。総当たり検索を使います")
+    if index_type == "hnsw":
+        hnsw = faiss.IndexHNSWFlat(dimension, hnsw_m)
+        hnsw.hnsw.efSearch = ef_search
+        return faiss.IndexIDMap(hnsw)
+    return faiss.IndexIDMap(faiss.IndexFlatL2(dimension))
+
+
+def index_kind(index) -> str:
+    """実際のインデックスの種類（flat / ivf / hnsw）。IVFの件数不足で総当たりにしたものはflat"""
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf"
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def _supports_remove(index) -> bool:
+    # HNSWは削除に対応していないため作り直す
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    return not isinstance(inner, faiss.IndexHNSW)
+
+
+class VectorIndex:
+    def __init__(self, db_path: str, index_path: str, model, table: str = "documents",
+                 index_type: str = INDEX_TYPE):
+        self.index_path = index_path
+        self.model = model
+        self.table = table
+        self.index_type = index_type
+        self.dimension = model.get_sentence_embedding_dimension()
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, text TEXT, sha256 TEXT UNIQUE, embedding BLOB)"
+        )
+        self.conn.commit()
+        self._embed_missing()
+        self.index = self._load_index()
+
+    def encode(self, texts) -> np.ndarray:
+        return np.asarray(self.model.encode(list(texts), batch_size=EMBED_BATCH_SIZE), dtype=np.float32)
+
+    def _embed_missing(self):
+        """埋め込みが保存されていない行だけを埋め込む"""
+        rows = self.conn.execute(f"SELECT id, text FROM {self.table} WHERE embedding IS NULL").fetchall()
+        if not rows:
+            return
+        ids, texts = zip(*rows)
+        embeddings = self.encode(texts)
+        self.conn.executemany(
+            f"UPDATE {self.table} SET embedding = ? WHERE id = ?",
+            [(e.tobytes(), i) for e, i in zip(embeddings, ids)],
+        )
+        self.conn.commit()
+        logger.info(f"{self.table}: {len(rows)}件の埋め込みを保存しました")
+
+    def stored_embeddings(self):
+        rows = self.conn.execute(f"SELECT id, embedding FROM {self.table}").fetchall()
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, self.dimension), dtype=np.float32)
+        ids = np.array([r[0] for r in rows], dtype=np.int64)
+        embeddings = np.frombuffer(b"".join(r[1] for r in rows), dtype=np.float32).reshape(len(rows), -1)
+        return ids, embeddings
+
+    def _expected_kind(self, count: int) -> str:
+        # IVFは十分に学習できる件数（nlist×39）に達するまでは総当たりで持つ
+        if self.index_type == "ivf" and count < IVF_NLIST * IVF_POINTS_PER_CENTROID:
+            return "flat"
+        return self.index_type
+
+    def _load_index(self):
+        count = self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        if os.path.exists(self.index_path):
+            start = time.perf_counter()
+            index = faiss.read_index(self.index_path)
+            kind = index_kind(index)
+            if index.ntotal != count:
+                logger.warning(f"{self.table}: インデックス({index.ntotal}件)とDB({count}件)が一致しないため作り直します")
+            elif kind != self._expected_kind(count):
+                # 設定した種類が変わった、またはIVFを学習できる件数に達した
+                logger.warning(f"{self.table}: インデックスの種類({kind})が設定({self.index_type})と異なるため作り直します")
+            else:
+                logger.info(f"{self.table}: インデックスを読み込みました（{count}件, {time.perf_counter() - start:.2f}秒）")
+                return index
+        return self.rebuild()
+
+    def rebuild(self):
+        """保存済みの埋め込みからインデックスを作り直す（再埋め込みはしない）"""
+        start = time.perf_counter()
+        ids, embeddings = self.stored_embeddings()
+        index = build_index(self.dimension, self.index_type, embeddings)
+        if len(ids):
+            index.add_with_ids(embeddings, ids)
+        faiss.write_index(index, self.index_path)
+        self.index = index
+        logger.info(f"{self.table}: インデックスを作成しました（{len(ids)}件, {time.perf_counter() - start:.2f}秒）")
+        return index
+
+    def add(self, texts) -> list:
+        """未登録の文書だけを埋め込んで追加し、追加したIDを返す"""
+        with self._lock:
+            new_texts, hashes = [], []
+            for text in texts:
+                text = text.strip()
+                sha256 = hashlib.sha256(text.encode("utf-8")).hexdigest()
+                if sha256 in hashes or self.conn.execute(
+                    f"SELECT 1 FROM {self.table} WHERE sha256 = ?", (sha256,)
+                ).fetchone():
+                    continue
+                new_texts.append(text)
+                hashes.append(sha256)
+            if not new_texts:
+                return []
+            embeddings = self.encode(new_texts)
+            new_ids = []
+            for text, sha256, embedding in zip(new_texts, hashes, embeddings):
+                cursor = self.conn.execute(
+                    f"INSERT INTO {self.table} (text, sha256, embedding) VALUES (?, ?, ?)",
+                    (text, sha256, embedding.tobytes()),
+                )
+                new_ids.append(cursor.lastrowid)
+            self.conn.commit()
+            if index_kind(self.index) != self._expected_kind(self.index.ntotal + len(new_ids)):
+                # 空から追加してきたIVFが学習できる件数に達したら、保存済みの埋め込みで学習し直す
+                self.rebuild()
+            else:
+                self.index.add_with_ids(embeddings, np.array(new_ids, dtype=np.int64))
+                faiss.write_index(self.index, self.index_path)
+        logger.info(f"{self.table}: {len(new_ids)}件追加しました（合計{self.index.ntotal}件）")
+        return new_ids
+
+    def delete(self, ids):
+        with self._lock:
+            ids = [int(i) for i in ids]
+            self.conn.execute(
+                f"DELETE FROM {self.table} WHERE id IN ({','.join('?' * len(ids))})", ids
+            )
+            self.conn.commit()
+            if _supports_remove(self.index):
+                self.index.remove_ids(np.array(ids, dtype=np.int64))
+                faiss.write_index(self.index, self.index_path)
+            else:
+                self.rebuild()
+
+    def search_vectors(self, vectors: np.ndarray, k: int):
+        k = min(k, self.index.ntotal)
+        if k == 0:
+            return np.zeros((len(vectors), 0), dtype=np.float32), np.zeros((len(vectors), 0), dtype=np.int64)
+        return self.index.search(np.asarray(vectors, dtype=np.float32), k)
+
+    def search(self, queries, k: int = 3) -> list:
+        """複数のクエリをまとめて埋め込み・検索し、クエリごとに(id, 距離, テキスト)のリストを返す"""
+        distances, indices = self.search_vectors(self.encode(queries), k)
+        all_ids = sorted({int(i) for row in indices for i in row if i != -1})
+        texts = {}
+        if all_ids:
+            # 全クエリの結果を1回のSQLで取得する
+            texts = dict(self.conn.execute(
+                f"SELECT id, text FROM {self.table} WHERE id IN ({','.join('?' * len(all_ids))})", all_ids
+            ).fetchall())
+        return [
+            [(int(i), float(d), texts[int(i)]) for d, i in zip(dist_row, id_row) if int(i) in texts]
+            for dist_row, id_row in zip(distances, indices)
+        ]
+
+
+def benchmark_ann(embeddings: np.ndarray, queries: np.ndarray, k: int = 10,
+                  nprobes=(1, 4, 16, 64), ef_searches=(16, 64, 256)) -> list:
+    """総当たり検索を正解として、IVF/HNSWの再現率と1クエリあたりの検索時間を比較する"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    dimension = embeddings.shape[1]
+    ids = np.arange(len(embeddings), dtype=np.int64)
+
+    def run(name, index):
+        start = time.perf_counter()
+        _, found = index.search(queries, k)
+        per_query_ms = (time.perf_counter() - start) / len(queries) * 1000
+        recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+        result = {"index": name, "recall": float(recall), "ms_per_query": per_query_ms}
+        logger.info(f"{name}: recall@{k}={recall:.3f}, {per_query_ms:.3f}ms/query")
+        return result
+
+    flat = build_index(dimension, "flat")
+    flat.add_with_ids(embeddings, ids)
+    start = time.perf_counter()
+    _, truth = flat.search(queries, k)
+    flat_ms = (time.perf_counter() - start) / len(queries) * 1000
+    results = [{"index": "flat", "recall": 1.0, "ms_per_query": flat_ms}]
+    logger.info(f"flat: {flat_ms:.3f}ms/query")
+
+    build_start = time.perf_counter()
+    ivf = build_index(dimension, "ivf", embeddings, nlist=max(1, min(IVF_NLIST, len(embeddings) // IVF_POINTS_PER_CENTROID)))
+    ivf.add_with_ids(embeddings, ids)
+    logger.info(f"ivf 構築: {time.perf_counter() - build_start:.2f}秒")
+    if isinstance(ivf, faiss.IndexIVF):
+        for nprobe in nprobes:
+            ivf.nprobe = nprobe
+            results.append(run(f"ivf(nprobe={nprobe})", ivf))
+
+    build_start = time.perf_counter()
+    hnsw = build_index(dimension, "hnsw")
+    hnsw.add_with_ids(embeddings, ids)
+    logger.info(f"hnsw 構築: {time.perf_counter() - build_start:.2f}秒")
+    for ef in ef_searches:
+        faiss.downcast_index(hnsw.index).hnsw.efSearch = ef
+        results.append(run(f"hnsw(efSearch={ef})", hnsw))
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    # python vector_index.py [件数] : 乱数ベクトルで再現率と検索時間を比較する
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((n, 768)).astype(np.float32)
+    benchmark_ann(data, data[rng.choice(n, 200, replace=False)] + 0.1 * rng.standard_normal((200, 768)).astype(np.float32))